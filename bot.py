@@ -1,3 +1,4 @@
+import asyncio
 import discord
 from discord.ext import commands, tasks
 from discord.ui import View, Select, Button
@@ -6,8 +7,11 @@ from dotenv import load_dotenv
 from database import Database
 from datetime import datetime
 import pytz
-import io
-from image_utils import create_stats_image
+from image_utils import create_stats_image, open_http_session, close_http_session, start_render_executor, stop_render_executor, load_badges
+from rate_limit import RateLimiter
+from transcript import Transcript, write_transcript, write_captured_transcript
+from jobs import JobQueue, JobFailed
+from user_resolver import UserResolver
 
 load_dotenv()
 
@@ -17,7 +21,11 @@ intents.members = True
 intents.guilds = True
 
 bot = commands.Bot(command_prefix='.', intents=intents)
-db = Database()
+db = Database(
+    pragma_profile=os.getenv('DB_PRAGMA_PROFILE', 'durable'),
+    write_behind=os.getenv('DB_WRITE_BEHIND', '0') == '1',
+    capture_messages=os.getenv('CAPTURE_TRANSCRIPTS', '0') == '1'
+)
 
 EMBED_COLOR = 0xf9e6f0
 
@@ -42,6 +50,16 @@ ROLE_EMOJIS = {
 ROLE_ORDER = ['owner', 'co-owner', 'head admin', 'admin', 'staff', 'trial staff']
 TRACKED_ROLE_IDS = [1390953916082028635, 1396008058693615678, 1428758437646307470]
 PING_ROLE_ID = 1407881544202195004
+HISTORY_WEEKS = 4
+
+job_queue = JobQueue(db)
+user_resolver = UserResolver(bot)
+
+# (capacity, seconds to refill) per user, per guild and across the bot
+ticket_limiter = RateLimiter(user=(2, 60), guild=(10, 60), global_=(30, 60))
+command_limiter = RateLimiter(user=(3, 30), guild=(20, 60), global_=(40, 60))
+# Staff-only and per user, so member spam on other commands can never block closes
+close_limiter = RateLimiter(user=(10, 60))
 
 STAFF_ROLE_HIERARCHY = {
     1390590641846878330: 'Owner',
@@ -63,6 +81,63 @@ async def has_staff_permission(member: discord.Member, guild_id: int) -> bool:
         return False
     return any(role.id in staff_roles for role in member.roles)
 
+async def open_ticket_thread(channel: discord.TextChannel, member: discord.Member, category: str, ticket_number: int) -> discord.Thread:
+    try:
+        thread = await channel.create_thread(
+            name=f"ticket-{ticket_number}",
+            type=discord.ChannelType.private_thread,
+            auto_archive_duration=10080
+        )
+    except Exception:
+        db.release_ticket(ticket_number)
+        raise
+    
+    embed = discord.Embed(
+        title=category.title(),
+        description=f"welcome! <:castorice_shy:1439122834692767827>\nthank you for opening a ticket, staff will be here shortly\nplease be patient as you wait\n\nopened by {member.mention}",
+        color=EMBED_COLOR
+    )
+    
+    # Once the thread exists, the DB write, adding the opener and the
+    # welcome ping do not depend on each other
+    finalized, *results = await asyncio.gather(
+        db.finalize_ticket(ticket_number, thread.id),
+        thread.add_user(member),
+        thread.send(f"<@&{PING_ROLE_ID}>", embed=embed),
+        return_exceptions=True
+    )
+    if isinstance(finalized, BaseException):
+        db.release_ticket(ticket_number)
+        await thread.delete()
+        raise finalized
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return thread
+
+async def promote_queued_tickets(guild: discord.Guild):
+    while True:
+        promoted = await db.promote_queued_ticket(guild.id)
+        if not promoted:
+            return
+        ticket_number, entry = promoted
+        channel = guild.get_channel(entry['channel_id'])
+        member = guild.get_member(entry['user_id'])
+        if not channel or not member:
+            db.release_ticket(ticket_number)
+            print(f"[DEBUG] Dropped queued ticket for user {entry['user_id']}: member or channel is gone")
+            continue
+        try:
+            await open_ticket_thread(channel, member, entry['category'], ticket_number)
+            print(f"[DEBUG] Opened queued ticket #{ticket_number} for {member.name} (ID: {member.id})")
+        except Exception as e:
+            print(f"[DEBUG] Failed to open queued ticket for {member.name}: {e}")
+            if await db.get_user_open_ticket_count(member.id) == 0:
+                # No ticket came of it: keep their place at the head and stop
+                # here, the next close or limit change tries again
+                await db.requeue_ticket(entry)
+                return
+
 class TicketCategorySelect(Select):
     def __init__(self):
         options = [
@@ -77,47 +152,64 @@ class TicketCategorySelect(Select):
     async def callback(self, interaction: discord.Interaction):
         category = self.values[0]
         
-        user_open_tickets = await db.get_user_open_ticket_count(interaction.user.id)
-        if user_open_tickets > 0:
+        retry_after = ticket_limiter.acquire(interaction.user.id, interaction.guild.id)
+        if retry_after:
             await interaction.response.send_message(
-                "you currently have a ticket open! >_<",
+                f"slow down! try again in {retry_after:.1f}s",
                 ephemeral=True
             )
             return
         
+        # Acknowledge first so the 3 second interaction deadline never depends on the DB
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        
+        try:
+            await self.open_or_queue(interaction, category)
+        except Exception:
+            # A deferred interaction otherwise stays on "thinking..." until it expires
+            try:
+                await interaction.followup.send("Something went wrong opening your ticket, please try again.", ephemeral=True)
+            except discord.HTTPException:
+                pass
+            raise
+    
+    async def open_or_queue(self, interaction: discord.Interaction, category: str):
         ticket_limit = await db.get_ticket_limit(interaction.guild.id)
-        open_tickets = await db.get_open_ticket_count()
         
-        if ticket_limit > 0 and open_tickets >= ticket_limit:
-            await interaction.response.send_message(
-                "TAIYO is currently at max tickets. Please try again later.",
+        # Nothing below awaits until the ticket is reserved or queued, so a
+        # double click cannot get two callbacks past these checks
+        if db.has_open_ticket(interaction.user.id):
+            await interaction.followup.send(
+                "you currently have a ticket open! >_<",
                 ephemeral=True
             )
             return
         
-        ticket_number = await db.create_ticket(0, category, interaction.user.id)
-        
-        thread = await interaction.channel.create_thread(
-            name=f"ticket-{ticket_number}",
-            type=discord.ChannelType.private_thread,
-            auto_archive_duration=10080
-        )
-        
-        await db.execute_raw(
-            'UPDATE tickets SET channel_id = ? WHERE ticket_number = ?',
-            (thread.id, ticket_number)
-        )
+        # Once anyone is waiting, new requests line up behind them instead of
+        # racing the queue for the next free slot
+        if not db.has_free_slot(interaction.guild.id, ticket_limit):
+            await db.enqueue_ticket(interaction.guild.id, interaction.user.id, category, interaction.channel.id)
+            await promote_queued_tickets(interaction.guild)
+            position = await db.get_queue_position(interaction.guild.id, interaction.user.id)
+            if position is None:
+                ticket_channels = await db.get_user_open_ticket_channels(interaction.user.id)
+                if ticket_channels:
+                    await interaction.followup.send(f"Ticket created! <#{ticket_channels[0]}>", ephemeral=True)
+                else:
+                    await interaction.followup.send("Something went wrong opening your ticket, please try again.", ephemeral=True)
+                return
+            await interaction.followup.send(
+                f"TAIYO is currently at max tickets. You're #{position} in the queue, your ticket will open automatically once a slot frees up.",
+                ephemeral=True
+            )
+            return
         
-        await thread.add_user(interaction.user)
+        # Hold a ticket number while the thread is created; the ticket row is
+        # written once, with the real thread id, only after that succeeds
+        ticket_number = db.reserve_ticket(category, interaction.user.id, interaction.guild.id)
+        thread = await open_ticket_thread(interaction.channel, interaction.user, category, ticket_number)
         
-        embed = discord.Embed(
-            title=category.title(),
-            description=f"welcome! <:castorice_shy:1439122834692767827>\nthank you for opening a ticket, staff will be here shortly\nplease be patient as you wait\n\nopened by {interaction.user.mention}",
-            color=EMBED_COLOR
-        )
-        await thread.send(f"<@&{PING_ROLE_ID}>", embed=embed)
-        
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"Ticket created! {thread.mention}",
             ephemeral=True
         )
@@ -153,7 +245,6 @@ class ConfirmView(View):
 
 @bot.event
 async def on_ready():
-    await db.init_db()
     bot.add_view(TicketView())
     print(f'Bot is ready! Logged in as {bot.user}')
     if not update_ticket_status.is_running():
@@ -162,6 +253,8 @@ async def on_ready():
         weekly_reset_task.start()
     if not sunday_leaderboard.is_running():
         sunday_leaderboard.start()
+    for guild in bot.guilds:
+        await promote_queued_tickets(guild)
 
 @bot.event
 async def on_member_update(before: discord.Member, after: discord.Member):
@@ -176,6 +269,31 @@ async def on_member_update(before: discord.Member, after: discord.Member):
         await db.update_role_assignment_date(after.id, timestamp)
         print(f"[DEBUG] Updated role assignment date for {after.name} (ID: {after.id})")
 
+@bot.listen('on_member_remove')
+async def leave_ticket_queue(member: discord.Member):
+    # Otherwise they would only be dropped once they reached the head of the queue
+    if await db.remove_from_queue(member.guild.id, member.id):
+        print(f"[DEBUG] Removed {member.name} (ID: {member.id}) from the ticket queue: left the server")
+
+@bot.listen('on_message')
+async def capture_ticket_message(message: discord.Message):
+    if db.capture_messages and db.is_open_ticket(message.channel.id):
+        db.queue_ticket_message(
+            message.channel.id, message.id, str(message.author),
+            message.created_at.isoformat(), message.content
+        )
+
+@bot.listen('on_raw_message_edit')
+async def capture_ticket_message_edit(payload: discord.RawMessageUpdateEvent):
+    # Edits that don't touch the content (embeds resolving, pins) carry no content key
+    if db.capture_messages and db.is_open_ticket(payload.channel_id) and 'content' in payload.data:
+        db.queue_ticket_message_edit(payload.channel_id, payload.message_id, payload.data['content'])
+
+@bot.listen('on_raw_message_delete')
+async def capture_ticket_message_delete(payload: discord.RawMessageDeleteEvent):
+    if db.capture_messages and db.is_open_ticket(payload.channel_id):
+        db.queue_ticket_message_delete(payload.channel_id, payload.message_id)
+
 @bot.command()
 async def sendticket(ctx):
     if ctx.author.id != ctx.guild.owner_id:
@@ -201,6 +319,7 @@ async def ticketlimit(ctx, limit: int):
     
     await db.set_ticket_limit(ctx.guild.id, limit)
     await ctx.send(f"Ticket limit set to {limit}!", delete_after=5)
+    await promote_queued_tickets(ctx.guild)
 
 @bot.command()
 async def setarchive(ctx, channel: discord.TextChannel):
@@ -274,21 +393,21 @@ async def claim(ctx, force: str = ""):
     if not isinstance(ctx.channel, discord.Thread):
         return
     
-    ticket_info = await db.get_ticket_info(ctx.channel.id)
-    if not ticket_info:
-        return
-    
     if force == "force":
         if not any(role.name.lower() in ['admin', 'mod', 'moderator'] for role in ctx.author.roles):
             return
         
-        if ticket_info['handler_id']:
-            await db.unclaim_ticket(ctx.channel.id)
+        if not await db.claim_ticket(ctx.channel.id, ctx.author.id):
+            return
     else:
         if not await has_staff_permission(ctx.author, ctx.guild.id):
             return
-    
-    await db.claim_ticket(ctx.channel.id, ctx.author.id)
+        
+        if not await db.claim_ticket_if_unclaimed(ctx.channel.id, ctx.author.id):
+            ticket_info = await db.get_ticket_info(ctx.channel.id)
+            if ticket_info and ticket_info['status'] == 'open' and ticket_info['handler_id']:
+                await ctx.send(f"This ticket is already claimed by <@{ticket_info['handler_id']}>!", delete_after=5)
+            return
     
     embed = discord.Embed(
         description=f"{ctx.author.mention} has claimed the ticket",
@@ -312,17 +431,10 @@ async def forceclaim(ctx, member: discord.Member):
         await ctx.send("Only admins can use this command!", ephemeral=True)
         return
     
-    ticket_info = await db.get_ticket_info(ctx.channel.id)
-    if not ticket_info:
+    # Claim for the specified member, replacing any previous handler
+    if not await db.claim_ticket(ctx.channel.id, member.id):
         return
     
-    # If ticket is already claimed, unclaim the previous handler
-    if ticket_info['handler_id']:
-        await db.unclaim_ticket(ctx.channel.id)
-    
-    # Claim for the specified member
-    await db.claim_ticket(ctx.channel.id, member.id)
-    
     embed = discord.Embed(
         description=f"{member.mention} has been given credit!",
         color=EMBED_COLOR
@@ -345,18 +457,12 @@ async def forceunclaim(ctx, member: discord.Member):
         await ctx.send("Only admins can use this command!", ephemeral=True)
         return
     
-    ticket_info = await db.get_ticket_info(ctx.channel.id)
-    if not ticket_info:
+    # Only unclaims if the member is actually the handler
+    if not await db.unclaim_ticket_if_handler(ctx.channel.id, member.id):
+        if db.is_open_ticket(ctx.channel.id):
+            await ctx.send(f"{member.mention} is not handling this ticket!", ephemeral=True)
         return
     
-    # Check if the member is actually the handler
-    if ticket_info['handler_id'] != member.id:
-        await ctx.send(f"{member.mention} is not handling this ticket!", ephemeral=True)
-        return
-    
-    # Unclaim the ticket
-    await db.unclaim_ticket(ctx.channel.id)
-    
     embed = discord.Embed(
         description=f"{member.mention} has been unclaimed from this ticket!",
         color=EMBED_COLOR
@@ -370,23 +476,20 @@ async def unclaim(ctx, force: str = ""):
     if not isinstance(ctx.channel, discord.Thread):
         return
 
-    ticket_info = await db.get_ticket_info(ctx.channel.id)
-    if not ticket_info:
-        return
-
     if force == "force":
         if not any(role.name.lower() in ['admin', 'mod', 'moderator'] for role in ctx.author.roles):
             return
 
+        if not await db.unclaim_ticket(ctx.channel.id):
+            return
+
     else:
         if not await has_staff_permission(ctx.author, ctx.guild.id):
             return
 
-        if ticket_info['handler_id'] != ctx.author.id:
+        if not await db.unclaim_ticket_if_handler(ctx.channel.id, ctx.author.id):
             return
 
-    await db.unclaim_ticket(ctx.channel.id)
-
 
 
     embed = discord.Embed(
@@ -407,12 +510,17 @@ async def close(ctx, *, reason: str = "No reason provided"):
     if not await has_staff_permission(ctx.author, ctx.guild.id):
         return
     
+    retry_after = close_limiter.acquire(ctx.author.id)
+    if retry_after:
+        await ctx.send(f"slow down! try again in {retry_after:.1f}s", delete_after=5)
+        return
+    
     ticket_info = await db.get_ticket_info(ctx.channel.id)
     if not ticket_info:
         await ctx.send("This is not a valid ticket thread!")
         return
     
-    handler = await bot.fetch_user(ticket_info['handler_id']) if ticket_info['handler_id'] else None
+    handler = await user_resolver.resolve(ticket_info['handler_id'], ctx.guild) if ticket_info['handler_id'] else None
     credit_text = handler.mention if handler else "No one"
     
     confirmation_embed = discord.Embed(
@@ -431,57 +539,74 @@ async def close(ctx, *, reason: str = "No reason provided"):
         await msg.edit(content="Ticket close cancelled.", view=None, embed=None)
         return
     
-    await db.close_ticket(ctx.channel.id, ctx.author.id, reason)
-    
-    ticket_info = await db.get_ticket_info(ctx.channel.id)
+    ticket_info = await db.close_ticket(
+        ctx.channel.id, ctx.author.id, reason,
+        job=('ticket_closed', {'guild_id': ctx.guild.id})
+    )
     if not ticket_info:
-        await msg.edit(content="Error: Could not retrieve ticket information.", view=None)
+        await msg.edit(content="This ticket is already closed.", view=None, embed=None)
         return
     
-    messages = []
-    async for message in ctx.channel.history(limit=None, oldest_first=True):
-        messages.append(message)
+    # The archive post and the opener DM run on the job queue
+    job_queue.notify()
+    
+    close_embed = discord.Embed(
+        title=f"ticket closed <a:Heart:1396388971818520576>",
+        description=f"this ticket was closed by {ctx.author.mention}\n\n**reason:**\n{reason}",
+        color=EMBED_COLOR
+    )
+    
+    await msg.edit(embed=close_embed, view=None)
+    await ctx.channel.edit(archived=True, locked=True)
+    await promote_queued_tickets(ctx.guild)
+
+async def ticket_closed_job(payload: dict, checkpoint):
+    await bot.wait_until_ready()
+    ticket_info = payload['ticket']
+    channel_id = ticket_info['channel_id']
+    jump_url = f"https://discord.com/channels/{payload['guild_id']}/{channel_id}"
     
-    html_content = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>Ticket #{ticket_info['ticket_number']}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; padding: 20px; background: #36393f; color: #dcddde; }}
-        .message {{ margin: 10px 0; padding: 10px; background: #40444b; border-radius: 5px; }}
-        .author {{ color: #7289da; font-weight: bold; }}
-        .timestamp {{ color: #72767d; font-size: 0.8em; }}
-    </style>
-</head>
-<body>
-    <h1>Ticket #{ticket_info['ticket_number']}</h1>
-"""
-    for msg in messages:
-        timestamp = msg.created_at.strftime("%Y-%m-%d %H:%M:%S")
-        content = msg.content.replace('<', '&lt;').replace('>', '&gt;')
-        html_content += f'    <div class="message"><span class="author">{msg.author}</span> <span class="timestamp">{timestamp}</span><br>{content}</div>\n'
-    
-    html_content += "</body>\n</html>"
+    if db.has_full_capture(channel_id):
+        transcript = await write_captured_transcript(ticket_info['ticket_number'], db.iter_ticket_messages(channel_id))
+    else:
+        try:
+            channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+        except discord.NotFound:
+            raise JobFailed(f"Ticket #{ticket_info['ticket_number']} thread no longer exists")
+        transcript = await write_transcript(ticket_info['ticket_number'], channel)
+    try:
+        await send_ticket_closed_notices(payload, checkpoint, ticket_info, jump_url, transcript)
+    finally:
+        transcript.close()
+    if db.capture_messages:
+        await db.delete_ticket_messages(channel_id)
+
+async def send_ticket_closed_notices(payload: dict, checkpoint, ticket_info: dict, jump_url: str, transcript: Transcript):
     created_at = datetime.fromisoformat(ticket_info['created_at'])
     closed_at = datetime.fromisoformat(ticket_info['closed_at'])
     
-    opener = await bot.fetch_user(ticket_info['opener_id'])
-    handler = await bot.fetch_user(ticket_info['handler_id']) if ticket_info['handler_id'] else None
-    closer = await bot.fetch_user(ticket_info['closer_id'])
+    users = await user_resolver.resolve_many(
+        [ticket_info['opener_id'], ticket_info['handler_id'], ticket_info['closer_id']],
+        bot.get_guild(payload['guild_id'])
+    )
+    opener = users[ticket_info['opener_id']]
+    handler = users.get(ticket_info['handler_id'])
+    closer = users[ticket_info['closer_id']]
+    opener_mention = opener.mention if opener else f"<@{ticket_info['opener_id']}>"
+    closer_mention = closer.mention if closer else f"<@{ticket_info['closer_id']}>"
     
     created_timestamp = int(created_at.timestamp())
     closed_timestamp = int(closed_at.timestamp())
     
-    archive_channel_id = await db.get_archive_channel(ctx.guild.id)
-    if archive_channel_id:
+    archive_channel_id = await db.get_archive_channel(payload['guild_id'])
+    if archive_channel_id and not payload.get('archived'):
         archive_channel = bot.get_channel(archive_channel_id)
         if archive_channel:
             embed_description = f"""Ticket #{ticket_info['ticket_number']}
 **opened by**
-{opener.mention}
+{opener_mention}
 **closed by**
-{closer.mention}
+{closer_mention}
 **handled by**
 {handler.mention if handler else 'None'}
 **opened at**
@@ -489,26 +614,32 @@ async def close(ctx, *, reason: str = "No reason provided"):
 **closed at**
 <t:{closed_timestamp}:F>
 **reason**
-{reason}"""
+{ticket_info['close_reason']}"""
             
             transcript_embed = discord.Embed(
                 description=embed_description,
                 color=EMBED_COLOR
             )
             
-            file = discord.File(io.BytesIO(html_content.encode()), filename=f"ticket #{ticket_info['ticket_number']}.html")
+            file = transcript.to_file()
             
             button_view = View()
-            button_view.add_item(Button(label="View Thread", url=ctx.channel.jump_url))
+            button_view.add_item(Button(label="View Thread", url=jump_url))
             
             await archive_channel.send(embed=transcript_embed, file=file, view=button_view)
+            payload['archived'] = True
+            await checkpoint(payload)
+    
+    # Only the DM needs the opener; an unresolvable account (e.g. deleted) just skips it
+    if payload.get('dm_sent') or opener is None:
+        return
     
     try:
         dm_description = f"""Ticket #{ticket_info['ticket_number']}
 **opened by**
-{opener.mention}
+{opener_mention}
 **closed by**
-{closer.mention}
+{closer_mention}
 **handled by**
 {handler.mention if handler else 'None'}
 **opened at**
@@ -516,7 +647,7 @@ async def close(ctx, *, reason: str = "No reason provided"):
 **closed at**
 <t:{closed_timestamp}:F>
 **reason**
-{reason}"""
+{ticket_info['close_reason']}"""
         
         dm_embed = discord.Embed(
             description=dm_description,
@@ -524,21 +655,15 @@ async def close(ctx, *, reason: str = "No reason provided"):
         )
         
         dm_button_view = View()
-        dm_button_view.add_item(Button(label="View Thread", url=ctx.channel.jump_url))
+        dm_button_view.add_item(Button(label="View Thread", url=jump_url))
         
-        dm_file = discord.File(io.BytesIO(html_content.encode()), filename=f"ticket #{ticket_info['ticket_number']}.html")
+        dm_file = transcript.to_file()
         await opener.send(embed=dm_embed, file=dm_file, view=dm_button_view)
-    except:
-        pass
-    
-    close_embed = discord.Embed(
-        title=f"ticket closed <a:Heart:1396388971818520576>",
-        description=f"this ticket was closed by {ctx.author.mention}\n\n**reason:**\n{reason}",
-        color=EMBED_COLOR
-    )
-    
-    await msg.edit(embed=close_embed, view=None)
-    await ctx.channel.edit(archived=True, locked=True)
+    except discord.Forbidden:
+        # DMs closed or no shared server; retrying will not change that
+        print(f"[DEBUG] Could not DM transcript for ticket #{ticket_info['ticket_number']} to {opener}")
+    payload['dm_sent'] = True
+    await checkpoint(payload)
 
 @bot.command()
 async def fm(ctx):
@@ -610,18 +735,11 @@ async def addall(ctx, user_id: int):
     if not await has_staff_permission(ctx.author, ctx.guild.id):
         return
     
-    try:
-        member = await bot.fetch_user(user_id)
-    except discord.NotFound:
+    member = await user_resolver.resolve(user_id, ctx.guild)
+    if member is None:
         return
     
-    # Need to use a proper query to get results
-    async with __import__('aiosqlite').connect(db.db_path) as db_conn:
-        async with db_conn.execute("SELECT channel_id FROM tickets WHERE status = 'open'") as cursor:
-            tickets = await cursor.fetchall()
-    
-    for ticket_row in tickets:
-        channel_id = ticket_row[0]
+    for channel_id in await db.get_open_ticket_channels():
         channel = bot.get_channel(channel_id)
         if channel:
             try:
@@ -640,18 +758,11 @@ async def removeall(ctx, user_id: int):
     if not await has_staff_permission(ctx.author, ctx.guild.id):
         return
     
-    try:
-        member = await bot.fetch_user(user_id)
-    except discord.NotFound:
+    member = await user_resolver.resolve(user_id, ctx.guild)
+    if member is None:
         return
     
-    # Get all open tickets
-    async with __import__('aiosqlite').connect(db.db_path) as db_conn:
-        async with db_conn.execute("SELECT channel_id FROM tickets WHERE status = 'open'") as cursor:
-            tickets = await cursor.fetchall()
-    
-    for ticket_row in tickets:
-        channel_id = ticket_row[0]
+    for channel_id in await db.get_open_ticket_channels():
         channel = bot.get_channel(channel_id)
         if channel:
             try:
@@ -692,6 +803,11 @@ async def profile(ctx, action: str = "", *, message: str = ""):
 
 @bot.command()
 async def stats(ctx, member: discord.Member = None):
+    retry_after = command_limiter.acquire(ctx.author.id, ctx.guild.id)
+    if retry_after:
+        await ctx.send(f"slow down! try again in {retry_after:.1f}s", delete_after=5)
+        return
+    
     print(f"[DEBUG] Stats command called by {ctx.author} for {member}")
     if member is None:
         member = ctx.author
@@ -769,6 +885,11 @@ async def stats(ctx, member: discord.Member = None):
 
 @bot.command()
 async def lb(ctx, subcommand: str = "", member: discord.Member = None, role: str = ""):
+    retry_after = command_limiter.acquire(ctx.author.id, ctx.guild.id)
+    if retry_after:
+        await ctx.send(f"slow down! try again in {retry_after:.1f}s", delete_after=5)
+        return
+    
     print(f"[DEBUG] LB command called by {ctx.author} with subcommand '{subcommand}'")
     if subcommand == "add":
         if not any(r.name.lower() in ['admin', 'mod', 'moderator'] for r in ctx.author.roles):
@@ -809,6 +930,10 @@ async def lb(ctx, subcommand: str = "", member: discord.Member = None, role: str
         await show_leaderboard(ctx, "weekly", "closed")
         return
     
+    elif subcommand == "history":
+        await show_leaderboard_history(ctx, member)
+        return
+    
     else:
         await show_leaderboard(ctx, "all_time", "handled")
 
@@ -816,36 +941,16 @@ async def show_leaderboard(ctx, timeframe: str, stat_type: str):
     if not await has_staff_permission(ctx.author, ctx.guild.id):
         return
     
-    leaderboard_data = await db.get_leaderboard_data(
-        'weekly' if timeframe == 'weekly' else ('all_time_closed' if stat_type == 'closed' else 'all_time')
-    )
-    
-    user_roles = {}
-    for user_id, all_handled, all_closed, week_handled, week_closed in leaderboard_data:
-        lb_role = await db.get_user_leaderboard_role(user_id)
-        if lb_role:
-            if lb_role not in user_roles:
-                user_roles[lb_role] = []
-            
-            if timeframe == 'weekly':
-                if stat_type == 'closed':
-                    total = week_closed
-                    weekly_stat = week_closed
-                else:
-                    total = week_handled
-                    weekly_stat = week_handled
-                user_roles[lb_role].append((user_id, all_handled, weekly_stat, total))
-            else:
-                if stat_type == 'closed':
-                    total = all_closed
-                    weekly_stat = week_closed
-                else:
-                    total = all_handled
-                    weekly_stat = week_handled
-                user_roles[lb_role].append((user_id, total, weekly_stat, total))
-    
-    for role in user_roles:
-        user_roles[role].sort(key=lambda x: x[3], reverse=True)
+    weekly_col = 'weekly_closed' if stat_type == 'closed' else 'weekly_handled'
+    if timeframe == 'weekly':
+        leaderboards = await db.get_role_leaderboards('weekly', (weekly_col,))
+        all_time_col = 'all_time_handled'
+    else:
+        all_time_col = 'all_time_closed' if stat_type == 'closed' else 'all_time_handled'
+        leaderboards = await db.get_role_leaderboards(
+            'all_time_closed' if stat_type == 'closed' else 'all_time',
+            (all_time_col,)
+        )
     
     if stat_type == 'closed':
         title = "closed leaderboard 𐙚 ‧₊˚ ⋅"
@@ -854,12 +959,12 @@ async def show_leaderboard(ctx, timeframe: str, stat_type: str):
     
     description = ""
     for role in ROLE_ORDER:
-        if role in user_roles and user_roles[role]:
+        if leaderboards.get(role):
             emoji = ROLE_EMOJIS.get(role, "")
             description += f"\n{emoji} {role}\n"
             
-            for user_id, all_time_stat, weekly_stat, _ in user_roles[role]:
-                description += f"<@{user_id}> **{all_time_stat}** all - **{weekly_stat}** 7d\n"
+            for entry in leaderboards[role]:
+                description += f"<@{entry['user_id']}> **{entry[all_time_col]}** all - **{entry[weekly_col]}** 7d\n"
     
     if not description:
         description = "No leaderboard data available."
@@ -872,6 +977,39 @@ async def show_leaderboard(ctx, timeframe: str, stat_type: str):
     
     await ctx.send(embed=embed)
 
+async def show_leaderboard_history(ctx, member: discord.Member = None):
+    if not await has_staff_permission(ctx.author, ctx.guild.id):
+        return
+    
+    description = ""
+    if member:
+        title = f"{member.name} weekly history 𐙚 ‧₊˚ ⋅"
+        for week in await db.get_user_weekly_history(member.id, HISTORY_WEEKS):
+            ended_ts = int(datetime.fromisoformat(week['ended_at']).timestamp())
+            description += f"<t:{ended_ts}:d> **{week['handled']}** handled - **{week['closed']}** closed\n"
+    else:
+        title = "weekly history 𐙚 ‧₊˚ ⋅"
+        for role in ROLE_ORDER:
+            history = await db.get_role_weekly_history(role, HISTORY_WEEKS)
+            if not any(week['members'] for week in history):
+                continue
+            emoji = ROLE_EMOJIS.get(role, "")
+            description += f"\n{emoji} {role}\n"
+            for week in history:
+                ended_ts = int(datetime.fromisoformat(week['ended_at']).timestamp())
+                description += f"<t:{ended_ts}:d> **{week['handled']}** handled - **{week['closed']}** closed\n"
+    
+    if not description:
+        description = "No weekly history available yet."
+    
+    embed = discord.Embed(
+        title=title,
+        description=description,
+        color=EMBED_COLOR
+    )
+    
+    await ctx.send(embed=embed)
+
 @bot.command()
 async def modify(ctx, member: discord.Member, stat: str, value: int):
     if not any(role.name.lower() in ['admin', 'mod', 'moderator'] for role in ctx.author.roles):
@@ -912,10 +1050,8 @@ async def cleartickets(ctx, member: discord.Member = None):
         return
     
     target = member or ctx.author
-    await db.execute_raw(
-        "UPDATE tickets SET status = 'closed' WHERE opener_id = ? AND status = 'open'",
-        (target.id,)
-    )
+    await db.clear_user_tickets(target.id)
+    await promote_queued_tickets(ctx.guild)
     embed = discord.Embed(
         description=f"Cleared open tickets for {target.mention}!",
         color=EMBED_COLOR
@@ -958,38 +1094,24 @@ async def sunday_leaderboard():
                     await channel.send(embed=closed_data)
 
 async def build_leaderboard_embed(stat_type: str):
-    leaderboard_data = await db.get_leaderboard_data('all_time')
-    
-    user_roles = {}
-    for user_id, all_handled, all_closed, week_handled, week_closed in leaderboard_data:
-        lb_role = await db.get_user_leaderboard_role(user_id)
-        if lb_role:
-            if lb_role not in user_roles:
-                user_roles[lb_role] = []
-            
-            if stat_type == 'handled':
-                all_time_stat = all_handled
-                weekly_stat = week_handled
-            else:  # closed
-                all_time_stat = all_closed
-                weekly_stat = week_closed
-            
-            user_roles[lb_role].append((user_id, all_time_stat, weekly_stat))
+    if stat_type == 'handled':
+        all_time_col, weekly_col = 'all_time_handled', 'weekly_handled'
+    else:  # closed
+        all_time_col, weekly_col = 'all_time_closed', 'weekly_closed'
     
-    for role in user_roles:
-        user_roles[role].sort(key=lambda x: x[1] + x[2], reverse=True)
+    leaderboards = await db.get_role_leaderboards('all_time', (all_time_col, weekly_col))
     
     stat_label = "Handled" if stat_type == 'handled' else "Closed"
     title = f"𝐋𝐄𝐀𝐃𝐄𝐑𝐁𝐎𝐀𝐑𝐃 – {stat_label} 𐙚 ‧₊˚ ⋅"
     
     description = ""
     for role in ROLE_ORDER:
-        if role in user_roles and user_roles[role]:
+        if leaderboards.get(role):
             emoji = ROLE_EMOJIS.get(role, "")
             description += f"\n{emoji} {role}\n"
             
-            for user_id, all_time_stat, weekly_stat in user_roles[role]:
-                description += f"<@{user_id}> **{all_time_stat}** all - **{weekly_stat}** 7d\n"
+            for entry in leaderboards[role]:
+                description += f"<@{entry['user_id']}> **{entry[all_time_col]}** all - **{entry[weekly_col]}** 7d\n"
     
     if not description:
         description = "No leaderboard data available."
@@ -1026,4 +1148,24 @@ async def testleaderboard(ctx):
     
     await ctx.send("Leaderboard posted to your leaderboard channel!", delete_after=5)
 
-bot.run(os.getenv('DISCORD_TOKEN'))
\ No newline at end of file
+async def main():
+    discord.utils.setup_logging()
+    await db.init_db()
+    await open_http_session()
+    await load_badges()
+    start_render_executor(os.getenv('RENDER_EXECUTOR', 'thread'), int(os.getenv('RENDER_WORKERS', '2')))
+    job_queue.register('ticket_closed', ticket_closed_job)
+    job_queue.start()
+    try:
+        async with bot:
+            await bot.start(os.getenv('DISCORD_TOKEN'))
+    finally:
+        await job_queue.stop()
+        await close_http_session()
+        stop_render_executor()
+        await db.close()
+
+# Guarded so spawned render workers can import this module without starting
+# a second copy of the bot
+if __name__ == '__main__':
+    asyncio.run(main())
\ No newline at end of file
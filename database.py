@@ -1,283 +1,1175 @@
+import asyncio
+import bisect
+import dataclasses
+import itertools
+import json
 import sqlite3
+import time
 import aiosqlite
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Tuple, FrozenSet
+
+# Connection PRAGMAs applied whenever a pooled connection is opened.
+# cache_size is negative so it is read as KiB rather than pages.
+PRAGMA_PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+}
+
+async def _migration_1_base_schema(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS tickets (
+            ticket_number INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER UNIQUE,
+            category TEXT,
+            opener_id INTEGER,
+            handler_id INTEGER,
+            closer_id INTEGER,
+            created_at TEXT,
+            closed_at TEXT,
+            close_reason TEXT,
+            status TEXT DEFAULT 'open'
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            all_time_handled INTEGER DEFAULT 0,
+            all_time_closed INTEGER DEFAULT 0,
+            weekly_handled INTEGER DEFAULT 0,
+            weekly_closed INTEGER DEFAULT 0,
+            profile_message TEXT,
+            role_assignment_date TEXT
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS leaderboard_roles (
+            user_id INTEGER,
+            role_name TEXT,
+            PRIMARY KEY (user_id, role_name)
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS server_config (
+            guild_id INTEGER PRIMARY KEY,
+            ticket_limit INTEGER DEFAULT 0,
+            archive_channel_id INTEGER,
+            ticket_message_id INTEGER,
+            ticket_channel_id INTEGER,
+            leaderboard_channel_id INTEGER,
+            staff_role_ids TEXT,
+            admin_role_ids TEXT,
+            owner_role_ids TEXT,
+            moderator_role_ids TEXT
+        )
+    ''')
+    
+    # Databases created before versioning may predate the role type columns
+    async with db.execute("PRAGMA table_info(server_config)") as cursor:
+        column_names = [col[1] for col in await cursor.fetchall()]
+    for column in ('admin_role_ids', 'owner_role_ids', 'moderator_role_ids'):
+        if column not in column_names:
+            await db.execute(f'ALTER TABLE server_config ADD COLUMN {column} TEXT')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_reset (
+            id INTEGER PRIMARY KEY,
+            last_reset TEXT
+        )
+    ''')
+
+async def _migration_2_ticket_indexes(db: aiosqlite.Connection):
+    # Covers the open/closed counts and the open channel scans
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tickets_status_channel
+        ON tickets (status, channel_id)
+    ''')
+    # Covers the per-user open ticket check on ticket creation
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tickets_opener_status
+        ON tickets (opener_id, status)
+    ''')
+
+async def _migration_3_ticket_counters(db: aiosqlite.Connection):
+    await db.execute('ALTER TABLE tickets ADD COLUMN guild_id INTEGER')
+    
+    # Exact per guild/category/status ticket totals, maintained by the triggers
+    # below. Tickets created before guild_id existed are counted under guild 0.
+    await db.execute('''
+        CREATE TABLE ticket_counts (
+            guild_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, category, status)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('''
+        INSERT INTO ticket_counts (guild_id, category, status, count)
+        SELECT COALESCE(guild_id, 0), COALESCE(category, ''), COALESCE(status, 'open'), COUNT(*)
+        FROM tickets
+        GROUP BY 1, 2, 3
+    ''')
+    
+    increment = '''
+        INSERT INTO ticket_counts (guild_id, category, status, count)
+        VALUES (COALESCE(NEW.guild_id, 0), COALESCE(NEW.category, ''), COALESCE(NEW.status, 'open'), 1)
+        ON CONFLICT (guild_id, category, status) DO UPDATE SET count = count + 1;
+    '''
+    decrement = '''
+        UPDATE ticket_counts SET count = count - 1
+        WHERE guild_id = COALESCE(OLD.guild_id, 0)
+          AND category = COALESCE(OLD.category, '')
+          AND status = COALESCE(OLD.status, 'open');
+    '''
+    await db.execute(f'''
+        CREATE TRIGGER ticket_counts_insert AFTER INSERT ON tickets
+        BEGIN {increment} END
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER ticket_counts_update AFTER UPDATE OF guild_id, category, status ON tickets
+        WHEN OLD.guild_id IS NOT NEW.guild_id
+          OR OLD.category IS NOT NEW.category
+          OR OLD.status IS NOT NEW.status
+        BEGIN {decrement} {increment} END
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER ticket_counts_delete AFTER DELETE ON tickets
+        BEGIN {decrement} END
+    ''')
+
+async def _migration_4_week_epochs(db: aiosqlite.Connection):
+    # Weekly counters are only valid for the week_epoch stamped on their row;
+    # the weekly reset just advances the current epoch in weekly_reset
+    await db.execute('ALTER TABLE user_stats ADD COLUMN week_epoch INTEGER NOT NULL DEFAULT 0')
+    await db.execute('ALTER TABLE weekly_reset ADD COLUMN week_epoch INTEGER NOT NULL DEFAULT 0')
+    await db.execute('INSERT OR IGNORE INTO weekly_reset (id, last_reset, week_epoch) VALUES (1, NULL, 0)')
+
+async def _migration_5_weekly_snapshots(db: aiosqlite.Connection):
+    # One row per finished week, plus each user's weekly totals for that week
+    # and the leaderboard role they held when it ended
+    await db.execute('''
+        CREATE TABLE weekly_snapshot_weeks (
+            week_epoch INTEGER PRIMARY KEY,
+            ended_at TEXT NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE weekly_snapshots (
+            week_epoch INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role_name TEXT,
+            handled INTEGER NOT NULL,
+            closed INTEGER NOT NULL,
+            PRIMARY KEY (week_epoch, user_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('''
+        CREATE INDEX idx_weekly_snapshots_role
+        ON weekly_snapshots (role_name, week_epoch)
+    ''')
+    # Lets the reset snapshot only the users credited this week
+    await db.execute('CREATE INDEX idx_user_stats_week_epoch ON user_stats (week_epoch)')
+
+async def _migration_6_ticket_queue(db: aiosqlite.Connection):
+    # FIFO of users waiting for a free ticket slot; queue_id gives the order
+    await db.execute('''
+        CREATE TABLE ticket_queue (
+            queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            category TEXT,
+            channel_id INTEGER,
+            queued_at TEXT,
+            UNIQUE (guild_id, user_id)
+        )
+    ''')
+
+async def _migration_7_ticket_messages(db: aiosqlite.Connection):
+    # Messages captured live from open ticket threads, rendered into the
+    # transcript on close instead of re-fetching the thread history
+    await db.execute('''
+        CREATE TABLE ticket_messages (
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            author TEXT,
+            created_at TEXT,
+            content TEXT,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+
+async def _migration_8_jobs(db: aiosqlite.Connection):
+    # Durable queue for work that runs after a command has answered (see
+    # jobs.JobQueue). Finished jobs are deleted; exhausted ones stay as 'failed'.
+    await db.execute('''
+        CREATE TABLE jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            running INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            last_error TEXT,
+            created_at TEXT
+        )
+    ''')
+    await db.execute('CREATE INDEX idx_jobs_due ON jobs(status, running, run_after)')
+
+TICKET_COLUMNS = (
+    'ticket_number, channel_id, category, opener_id, handler_id, '
+    'closer_id, created_at, closed_at, close_reason, status, guild_id'
+)
+
+def _ticket_from_row(row) -> Dict:
+    return dict(zip([col.strip() for col in TICKET_COLUMNS.split(',')], row))
+
+@dataclasses.dataclass(frozen=True)
+class GuildConfig:
+    guild_id: int
+    ticket_limit: int = 0
+    archive_channel_id: Optional[int] = None
+    ticket_message_id: Optional[int] = None
+    ticket_channel_id: Optional[int] = None
+    leaderboard_channel_id: Optional[int] = None
+    staff_role_ids: FrozenSet[int] = frozenset()
+    admin_role_ids: FrozenSet[int] = frozenset()
+    owner_role_ids: FrozenSet[int] = frozenset()
+    moderator_role_ids: FrozenSet[int] = frozenset()
+
+GUILD_CONFIG_COLUMNS = tuple(field.name for field in dataclasses.fields(GuildConfig))
+ROLE_ID_COLUMNS = ('staff_role_ids', 'admin_role_ids', 'owner_role_ids', 'moderator_role_ids')
+
+def _parse_role_ids(value: Optional[str]) -> FrozenSet[int]:
+    if not value:
+        return frozenset()
+    return frozenset(int(rid) for rid in value.split(','))
+
+def _guild_config_from_row(row) -> GuildConfig:
+    values = dict(zip(GUILD_CONFIG_COLUMNS, row))
+    for column in ROLE_ID_COLUMNS:
+        values[column] = _parse_role_ids(values[column])
+    values['ticket_limit'] = values['ticket_limit'] or 0
+    return GuildConfig(**values)
+
+STAT_COLUMNS = ('all_time_handled', 'all_time_closed', 'weekly_handled', 'weekly_closed')
+WEEKLY_COLUMNS = ('weekly_handled', 'weekly_closed')
+
+# Columns summed to rank each leaderboard
+LEADERBOARD_STATS = {
+    'all_time': ('all_time_handled', 'all_time_closed'),
+    'weekly': ('weekly_handled', 'weekly_closed'),
+    'all_time_closed': ('all_time_closed',),
+    'weekly_closed': ('weekly_closed',),
+}
+
+class OpenTicketIndex:
+    # Resident copy of every open ticket, keyed by channel with a secondary
+    # opener lookup. Database rebuilds it at startup and updates it
+    # after each committed write that opens, claims or closes a ticket.
+    def __init__(self):
+        self.by_channel: Dict[int, Dict] = {}
+        self.by_opener: Dict[int, set] = {}
+    
+    def clear(self):
+        self.by_channel.clear()
+        self.by_opener.clear()
+    
+    def add(self, ticket: Dict):
+        self.by_channel[ticket['channel_id']] = ticket
+        self.by_opener.setdefault(ticket['opener_id'], set()).add(ticket['channel_id'])
+    
+    def remove(self, channel_id: int):
+        ticket = self.by_channel.pop(channel_id, None)
+        if ticket is None:
+            return
+        self._discard(self.by_opener, ticket['opener_id'], channel_id)
+    
+    def set_handler(self, channel_id: int, handler_id: Optional[int]):
+        ticket = self.by_channel.get(channel_id)
+        if ticket is not None:
+            ticket['handler_id'] = handler_id
+    
+    @staticmethod
+    def _discard(index: Dict[int, set], key: Optional[int], channel_id: int):
+        channels = index.get(key)
+        if channels is None:
+            return
+        channels.discard(channel_id)
+        if not channels:
+            del index[key]
+
+# Statements for the batched ticket_messages writes (see flush_ticket_messages)
+MESSAGE_OPS = {
+    'upsert': '''
+        INSERT INTO ticket_messages (channel_id, message_id, author, created_at, content)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(channel_id, message_id) DO UPDATE SET content = excluded.content
+    ''',
+    'edit': 'UPDATE ticket_messages SET content = ? WHERE channel_id = ? AND message_id = ?',
+    'delete': 'DELETE FROM ticket_messages WHERE channel_id = ? AND message_id = ?'
+}
+
+# Ordered (version, migration) pairs; the applied version is kept in PRAGMA user_version.
+# Append new migrations at the end and never edit one that has shipped.
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_ticket_indexes),
+    (3, _migration_3_ticket_counters),
+    (4, _migration_4_week_epochs),
+    (5, _migration_5_weekly_snapshots),
+    (6, _migration_6_ticket_queue),
+    (7, _migration_7_ticket_messages),
+    (8, _migration_8_jobs),
+]
 
 class Database:
-    def __init__(self, db_path: str = "bot_data.db"):
+    def __init__(
+        self,
+        db_path: str = "bot_data.db",
+        read_pool_size: int = 2,
+        pragma_profile: str = "durable",
+        pragmas: Optional[Dict] = None,
+        write_behind: bool = False,
+        flush_interval: float = 2.0,
+        flush_threshold: int = 100,
+        capture_messages: bool = False
+    ):
+        if pragma_profile not in PRAGMA_PROFILES:
+            raise ValueError(f"Unknown pragma profile: {pragma_profile}")
         self.db_path = db_path
+        self.read_pool_size = read_pool_size
+        self.pragmas = {**PRAGMA_PROFILES[pragma_profile], **(pragmas or {})}
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._reader_queue: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        self._guild_configs: Dict[int, GuildConfig] = {}
+        self._guild_config_generation = 0
+        self._week_epoch = 0
+        
+        # Ticket numbers reserved for threads still being created; the row is
+        # only written once the thread exists (see reserve_ticket)
+        self._next_ticket_number = 1
+        self._reservations: Dict[int, Dict] = {}
+        self._open_tickets = OpenTicketIndex()
+        
+        # Mirror of ticket_queue: sorted queue ids per guild (so a position is a
+        # bisect), the entries themselves, and (guild_id, user_id) -> queue_id
+        self._ticket_queues: Dict[int, List[int]] = {}
+        self._queue_entries: Dict[int, Dict] = {}
+        self._queued_users: Dict[Tuple[int, int], int] = {}
+        
+        # Write-behind buffer for user_stats: per-user counter deltas and
+        # last-write-wins column values, plus buffers currently being flushed
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending_deltas: Dict[int, Dict[str, int]] = {}
+        self._pending_sets: Dict[int, Dict[str, object]] = {}
+        self._inflight: List[Tuple[Dict, Dict]] = []
+        self._inflight_done: List[asyncio.Future] = []
+        self._flush_event = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        
+        # Live transcript capture: message writes are batched through the same
+        # flush loop. Only tickets opened while this process was capturing have
+        # a complete record; anything older falls back to the thread history.
+        self.capture_messages = capture_messages
+        self._pending_messages: List[Tuple[str, tuple]] = []
+        self._captured_channels: set = set()
+    
+    async def _open_connection(self, read_only: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        for name, value in self.pragmas.items():
+            # journal_mode is persistent in the file, so only the writer sets it
+            if name == 'journal_mode' and read_only:
+                continue
+            await conn.execute(f'PRAGMA {name} = {value}')
+        if read_only:
+            await conn.execute('PRAGMA query_only = ON')
+        return conn
+    
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._open_connection()
+        self._reader_queue = asyncio.Queue()
+        for _ in range(max(1, self.read_pool_size)):
+            conn = await self._open_connection(read_only=True)
+            self._readers.append(conn)
+            self._reader_queue.put_nowait(conn)
+        if self.write_behind or self.capture_messages:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        if self._writer is None:
+            return
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush_stats()
+        await self.flush_ticket_messages()
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+        self._reader_queue = None
+        await self._writer.close()
+        self._writer = None
+    
+    @asynccontextmanager
+    async def _read(self):
+        # Borrow a reader connection from the pool for the duration of a query
+        conn = await self._reader_queue.get()
+        try:
+            yield conn
+        finally:
+            self._reader_queue.put_nowait(conn)
+    
+    @asynccontextmanager
+    async def _write(self):
+        # Single writer; everything inside the block is committed as one transaction
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+    
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush_stats()
+            except Exception as e:
+                print(f"[DB] Stats flush failed, will retry: {e}")
+            try:
+                await self.flush_ticket_messages()
+            except Exception as e:
+                print(f"[DB] Message flush failed, will retry: {e}")
+    
+    def _queue_stat_deltas(self, deltas: Dict[int, Dict[str, int]]):
+        for user_id, columns in deltas.items():
+            pending = self._pending_deltas.setdefault(user_id, {})
+            for column, value in columns.items():
+                pending[column] = pending.get(column, 0) + value
+        self._check_flush_threshold()
+    
+    def _queue_stat_set(self, user_id: int, column: str, value):
+        self._pending_sets.setdefault(user_id, {})[column] = value
+        self._check_flush_threshold()
+    
+    def _check_flush_threshold(self):
+        if len(self._pending_deltas) + len(self._pending_sets) + len(self._pending_messages) >= self.flush_threshold:
+            self._flush_event.set()
+    
+    def _unflushed_buffers(self) -> List[Tuple[Dict, Dict]]:
+        # Oldest first so later column sets win when merged
+        return self._inflight + [(self._pending_deltas, self._pending_sets)]
+    
+    async def flush_stats(self):
+        # A batch another flush already took may still be waiting for the
+        # writer; callers read user_stats right after this, so wait for it
+        while self._inflight_done:
+            await asyncio.wait(list(self._inflight_done))
+        if not self._pending_deltas and not self._pending_sets:
+            return
+        buffer = (self._pending_deltas, self._pending_sets)
+        self._pending_deltas, self._pending_sets = {}, {}
+        done = asyncio.get_running_loop().create_future()
+        self._inflight.append(buffer)
+        self._inflight_done.append(done)
+        try:
+            async with self._write() as db:
+                await self._apply_stat_deltas(db, buffer[0])
+                await self._apply_stat_sets(db, buffer[1])
+        except BaseException:
+            # Put the batch back in front of anything queued since
+            deltas, sets = buffer
+            for user_id, columns in self._pending_deltas.items():
+                merged = deltas.setdefault(user_id, {})
+                for column, value in columns.items():
+                    merged[column] = merged.get(column, 0) + value
+            for user_id, columns in self._pending_sets.items():
+                sets.setdefault(user_id, {}).update(columns)
+            self._pending_deltas, self._pending_sets = deltas, sets
+            raise
+        finally:
+            self._inflight.remove(buffer)
+            self._inflight_done.remove(done)
+            done.set_result(None)
+    
+    def queue_ticket_message(self, channel_id: int, message_id: int, author: str, created_at: str, content: str):
+        self._pending_messages.append(('upsert', (channel_id, message_id, author, created_at, content)))
+        self._check_flush_threshold()
+    
+    def queue_ticket_message_edit(self, channel_id: int, message_id: int, content: str):
+        self._pending_messages.append(('edit', (content, channel_id, message_id)))
+        self._check_flush_threshold()
+    
+    def queue_ticket_message_delete(self, channel_id: int, message_id: int):
+        self._pending_messages.append(('delete', (channel_id, message_id)))
+        self._check_flush_threshold()
+    
+    async def flush_ticket_messages(self):
+        if not self._pending_messages:
+            return
+        batch, self._pending_messages = self._pending_messages, []
+        try:
+            async with self._write() as db:
+                # Consecutive operations of the same kind go in one executemany;
+                # order between kinds is kept so an edit never precedes its insert
+                for op, group in itertools.groupby(batch, key=lambda item: item[0]):
+                    await db.executemany(MESSAGE_OPS[op], [params for _, params in group])
+        except BaseException:
+            self._pending_messages = batch + self._pending_messages
+            raise
+    
+    def _stat_expr(self, column: str, alias: str = '') -> str:
+        # Weekly counters stamped with an older epoch belong to a past week
+        if column in WEEKLY_COLUMNS:
+            return f'(CASE WHEN {alias}week_epoch = {self._week_epoch} THEN {alias}{column} ELSE 0 END)'
+        return f'{alias}{column}'
+    
+    def _stats_select(self, alias: str = '') -> str:
+        return ', '.join(f'{self._stat_expr(column, alias)} AS {column}' for column in STAT_COLUMNS)
+    
+    async def _apply_stat_deltas(self, db: aiosqlite.Connection, deltas: Dict[int, Dict[str, int]]):
+        if not deltas:
+            return
+        await db.executemany('''
+            INSERT INTO user_stats (user_id, all_time_handled, all_time_closed, weekly_handled, weekly_closed, week_epoch)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                all_time_handled = all_time_handled + excluded.all_time_handled,
+                all_time_closed = all_time_closed + excluded.all_time_closed,
+                weekly_handled = CASE WHEN week_epoch = excluded.week_epoch THEN weekly_handled ELSE 0 END
+                    + excluded.weekly_handled,
+                weekly_closed = CASE WHEN week_epoch = excluded.week_epoch THEN weekly_closed ELSE 0 END
+                    + excluded.weekly_closed,
+                week_epoch = excluded.week_epoch
+        ''', [
+            (user_id, *(columns.get(column, 0) for column in STAT_COLUMNS), self._week_epoch)
+            for user_id, columns in deltas.items()
+        ])
+    
+    async def _apply_stat_sets(self, db: aiosqlite.Connection, sets: Dict[int, Dict[str, object]]):
+        for user_id, columns in sets.items():
+            for column, value in columns.items():
+                await db.execute(f'''
+                    INSERT INTO user_stats (user_id, {column})
+                    VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET {column} = excluded.{column}
+                ''', (user_id, value))
+    
+    def _apply_pending(self, stats: Dict) -> Dict:
+        for deltas, sets in self._unflushed_buffers():
+            for column, value in deltas.get(stats['user_id'], {}).items():
+                stats[column] += value
+            stats.update(sets.get(stats['user_id'], {}))
+        return stats
     
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS tickets (
-                    ticket_number INTEGER PRIMARY KEY AUTOINCREMENT,
-                    channel_id INTEGER UNIQUE,
-                    category TEXT,
-                    opener_id INTEGER,
-                    handler_id INTEGER,
-                    closer_id INTEGER,
-                    created_at TEXT,
-                    closed_at TEXT,
-                    close_reason TEXT,
-                    status TEXT DEFAULT 'open'
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS user_stats (
-                    user_id INTEGER PRIMARY KEY,
-                    all_time_handled INTEGER DEFAULT 0,
-                    all_time_closed INTEGER DEFAULT 0,
-                    weekly_handled INTEGER DEFAULT 0,
-                    weekly_closed INTEGER DEFAULT 0,
-                    profile_message TEXT,
-                    role_assignment_date TEXT
+        await self.open()
+        await self._migrate()
+        async with self._read() as db:
+            async with db.execute('SELECT week_epoch FROM weekly_reset WHERE id = 1') as cursor:
+                self._week_epoch = (await cursor.fetchone())[0]
+            async with db.execute('''
+                SELECT MAX(
+                    COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'tickets'), 0),
+                    COALESCE((SELECT MAX(ticket_number) FROM tickets), 0)
                 )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS leaderboard_roles (
-                    user_id INTEGER,
-                    role_name TEXT,
-                    PRIMARY KEY (user_id, role_name)
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS server_config (
-                    guild_id INTEGER PRIMARY KEY,
-                    ticket_limit INTEGER DEFAULT 0,
-                    archive_channel_id INTEGER,
-                    ticket_message_id INTEGER,
-                    ticket_channel_id INTEGER,
-                    leaderboard_channel_id INTEGER,
-                    staff_role_ids TEXT,
-                    admin_role_ids TEXT,
-                    owner_role_ids TEXT,
-                    moderator_role_ids TEXT
-                )
-            ''')
-            
-            async with db.execute("PRAGMA table_info(server_config)") as cursor:
-                columns = await cursor.fetchall()
-                column_names = [col[1] for col in columns]
-                if 'admin_role_ids' not in column_names:
-                    await db.execute('ALTER TABLE server_config ADD COLUMN admin_role_ids TEXT')
-                if 'owner_role_ids' not in column_names:
-                    await db.execute('ALTER TABLE server_config ADD COLUMN owner_role_ids TEXT')
-                if 'moderator_role_ids' not in column_names:
-                    await db.execute('ALTER TABLE server_config ADD COLUMN moderator_role_ids TEXT')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS weekly_reset (
-                    id INTEGER PRIMARY KEY,
-                    last_reset TEXT
-                )
-            ''')
-            
-            await db.commit()
+            ''') as cursor:
+                self._next_ticket_number = (await cursor.fetchone())[0] + 1
+        await self._load_open_tickets()
+        await self._load_ticket_queue()
+        # Jobs that were running when the process stopped are picked up again
+        async with self._write() as db:
+            await db.execute('UPDATE jobs SET running = 0 WHERE running = 1')
+        if self.capture_messages:
+            # Drop captures for tickets that were closed without a transcript
+            async with self._write() as db:
+                await db.execute('''
+                    DELETE FROM ticket_messages WHERE channel_id NOT IN (
+                        SELECT channel_id FROM tickets WHERE status = 'open'
+                    )
+                ''')
     
-    async def get_ticket_limit(self, guild_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def _load_open_tickets(self):
+        async with self._read() as db:
             async with db.execute(
-                'SELECT ticket_limit FROM server_config WHERE guild_id = ?',
-                (guild_id,)
+                f"SELECT {TICKET_COLUMNS} FROM tickets WHERE status = 'open'"
             ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else 0
+                rows = await cursor.fetchall()
+        self._open_tickets.clear()
+        for row in rows:
+            self._open_tickets.add(_ticket_from_row(row))
     
-    async def set_ticket_limit(self, guild_id: int, limit: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO server_config (guild_id, ticket_limit) 
-                VALUES (?, ?) 
-                ON CONFLICT(guild_id) DO UPDATE SET ticket_limit = ?
-            ''', (guild_id, limit, limit))
-            await db.commit()
-    
-    async def get_open_ticket_count(self) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT COUNT(*) FROM tickets WHERE status = 'open'"
-            ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else 0
+    async def _migrate(self):
+        async with self._write() as db:
+            async with db.execute('PRAGMA user_version') as cursor:
+                version = (await cursor.fetchone())[0]
+        
+        for target, migration in MIGRATIONS:
+            if target <= version:
+                continue
+            # Each migration and its version bump commit together or not at all
+            async with self._write() as db:
+                await db.execute('BEGIN')
+                await migration(db)
+                await db.execute(f'PRAGMA user_version = {target}')
+            print(f"[DB] Migrated schema to version {target}")
     
-    async def get_user_open_ticket_count(self, user_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def get_guild_config(self, guild_id: int) -> GuildConfig:
+        # server_config only changes through the set_* methods below, which
+        # keep this cache current, so each guild is read from disk once
+        config = self._guild_configs.get(guild_id)
+        if config is not None:
+            return config
+        generation = self._guild_config_generation
+        async with self._read() as db:
             async with db.execute(
-                "SELECT COUNT(*) FROM tickets WHERE opener_id = ? AND status = 'open'",
-                (user_id,)
+                f'SELECT {", ".join(GUILD_CONFIG_COLUMNS)} FROM server_config WHERE guild_id = ?',
+                (guild_id,)
             ) as cursor:
                 result = await cursor.fetchone()
-                return result[0] if result else 0
+        config = _guild_config_from_row(result) if result else GuildConfig(guild_id=guild_id)
+        # A set_* that landed while we were reading has already cached a newer value
+        if generation != self._guild_config_generation:
+            return self._guild_configs.get(guild_id, config)
+        return self._guild_configs.setdefault(guild_id, config)
     
-    async def get_closed_ticket_count(self) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT COUNT(*) FROM tickets WHERE status = 'closed'"
-            ) as cursor:
+    async def _set_guild_config(self, guild_id: int, **values):
+        columns = list(values)
+        async with self._write() as db:
+            async with db.execute(f'''
+                INSERT INTO server_config (guild_id, {", ".join(columns)})
+                VALUES (?, {", ".join("?" * len(columns))})
+                ON CONFLICT(guild_id) DO UPDATE SET
+                    {", ".join(f"{column} = excluded.{column}" for column in columns)}
+                RETURNING {", ".join(GUILD_CONFIG_COLUMNS)}
+            ''', (guild_id, *values.values())) as cursor:
                 result = await cursor.fetchone()
-                return result[0] if result else 0
+        self._guild_config_generation += 1
+        self._guild_configs[guild_id] = _guild_config_from_row(result)
+    
+    async def get_ticket_limit(self, guild_id: int) -> int:
+        return (await self.get_guild_config(guild_id)).ticket_limit
+    
+    async def set_ticket_limit(self, guild_id: int, limit: int):
+        await self._set_guild_config(guild_id, ticket_limit=limit)
+    
+    async def get_ticket_count(
+        self,
+        status: str,
+        guild_id: Optional[int] = None,
+        category: Optional[str] = None
+    ) -> int:
+        query = 'SELECT COALESCE(SUM(count), 0) FROM ticket_counts WHERE status = ?'
+        params = [status]
+        if guild_id is not None:
+            query += ' AND guild_id = ?'
+            params.append(guild_id)
+        if category is not None:
+            query += ' AND category = ?'
+            params.append(category)
+        async with self._read() as db:
+            async with db.execute(query, params) as cursor:
+                count = (await cursor.fetchone())[0]
+        # Reserved tickets already hold a slot
+        if status == 'open':
+            count += self._reserved_count(guild_id=guild_id, category=category)
+        return count
+    
+    async def get_open_ticket_count(self, guild_id: Optional[int] = None) -> int:
+        return await self.get_ticket_count('open', guild_id)
+    
+    async def get_user_open_ticket_count(self, user_id: int) -> int:
+        return len(self._open_tickets.by_opener.get(user_id, ())) + self._reserved_count(opener_id=user_id)
+    
+    async def get_closed_ticket_count(self, guild_id: Optional[int] = None) -> int:
+        return await self.get_ticket_count('closed', guild_id)
+    
+    async def _load_ticket_queue(self):
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT queue_id, guild_id, user_id, category, channel_id, queued_at
+                FROM ticket_queue ORDER BY queue_id
+            ''') as cursor:
+                rows = await cursor.fetchall()
+        self._ticket_queues.clear()
+        self._queue_entries.clear()
+        self._queued_users.clear()
+        for queue_id, guild_id, user_id, category, channel_id, queued_at in rows:
+            self._add_queue_entry({
+                'queue_id': queue_id,
+                'guild_id': guild_id,
+                'user_id': user_id,
+                'category': category,
+                'channel_id': channel_id,
+                'queued_at': queued_at
+            })
+    
+    def _add_queue_entry(self, entry: Dict):
+        bisect.insort(self._ticket_queues.setdefault(entry['guild_id'], []), entry['queue_id'])
+        self._queue_entries[entry['queue_id']] = entry
+        self._queued_users[(entry['guild_id'], entry['user_id'])] = entry['queue_id']
+    
+    def _pop_queue_entry(self, queue_id: int) -> Dict:
+        entry = self._queue_entries.pop(queue_id)
+        queue = self._ticket_queues[entry['guild_id']]
+        del queue[bisect.bisect_left(queue, queue_id)]
+        del self._queued_users[(entry['guild_id'], entry['user_id'])]
+        return entry
+    
+    def _open_slots_used(self) -> int:
+        return len(self._open_tickets.by_channel) + len(self._reservations)
+    
+    def has_open_ticket(self, user_id: int) -> bool:
+        return bool(self._open_tickets.by_opener.get(user_id)) or self._reserved_count(opener_id=user_id) > 0
+    
+    def has_free_slot(self, guild_id: int, ticket_limit: int) -> bool:
+        # Synchronous like promote_queued_ticket's check, so a caller can test
+        # it and reserve_ticket without yielding in between. Anyone already
+        # waiting gets the slot first.
+        if self._ticket_queues.get(guild_id):
+            return False
+        return ticket_limit <= 0 or self._open_slots_used() < ticket_limit
+    
+    async def get_queue_position(self, guild_id: int, user_id: int) -> Optional[int]:
+        queue_id = self._queued_users.get((guild_id, user_id))
+        if queue_id is None:
+            return None
+        return bisect.bisect_left(self._ticket_queues[guild_id], queue_id) + 1
     
-    async def create_ticket(self, channel_id: int, category: str, opener_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def enqueue_ticket(self, guild_id: int, user_id: int, category: str, channel_id: int) -> int:
+        position = await self.get_queue_position(guild_id, user_id)
+        if position is not None:
+            return position
+        queued_at = datetime.now(timezone.utc).isoformat()
+        async with self._write() as db:
             cursor = await db.execute('''
-                INSERT INTO tickets (channel_id, category, opener_id, created_at, status)
-                VALUES (?, ?, ?, ?, 'open')
-            ''', (channel_id, category, opener_id, datetime.now(timezone.utc).isoformat()))
-            await db.commit()
-            return cursor.lastrowid
-    
-    async def claim_ticket(self, channel_id: int, handler_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+                INSERT INTO ticket_queue (guild_id, user_id, category, channel_id, queued_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, user_id) DO NOTHING
+            ''', (guild_id, user_id, category, channel_id, queued_at))
+            queue_id = cursor.lastrowid if cursor.rowcount > 0 else None
+        if queue_id is None:
+            # A concurrent click queued them first
+            return await self.get_queue_position(guild_id, user_id)
+        self._add_queue_entry({
+            'queue_id': queue_id,
+            'guild_id': guild_id,
+            'user_id': user_id,
+            'category': category,
+            'channel_id': channel_id,
+            'queued_at': queued_at
+        })
+        return await self.get_queue_position(guild_id, user_id)
+    
+    async def remove_from_queue(self, guild_id: int, user_id: int) -> bool:
+        queue_id = self._queued_users.get((guild_id, user_id))
+        if queue_id is None:
+            return False
+        self._pop_queue_entry(queue_id)
+        async with self._write() as db:
+            await db.execute('DELETE FROM ticket_queue WHERE queue_id = ?', (queue_id,))
+        return True
+    
+    async def promote_queued_ticket(self, guild_id: int) -> Optional[Tuple[int, Dict]]:
+        # Hands the head of the queue a reserved ticket number if a slot is free.
+        # The capacity check, dequeue and reservation happen without yielding,
+        # so a concurrent ticket click cannot take the same slot.
+        queue = self._ticket_queues.get(guild_id)
+        if not queue:
+            return None
+        ticket_limit = (await self.get_guild_config(guild_id)).ticket_limit
+        if not queue or (ticket_limit > 0 and self._open_slots_used() >= ticket_limit):
+            return None
+        entry = self._pop_queue_entry(queue[0])
+        ticket_number = self.reserve_ticket(entry['category'], entry['user_id'], guild_id)
+        try:
+            async with self._write() as db:
+                await db.execute('DELETE FROM ticket_queue WHERE queue_id = ?', (entry['queue_id'],))
+        except BaseException:
+            self.release_ticket(ticket_number)
+            self._add_queue_entry(entry)
+            raise
+        return ticket_number, entry
+    
+    async def requeue_ticket(self, entry: Dict):
+        # Puts a promoted entry back under its original queue_id, which keeps it
+        # at the head; a newer entry the user made meanwhile is replaced
+        key = (entry['guild_id'], entry['user_id'])
+        async with self._write() as db:
+            await db.execute(
+                'DELETE FROM ticket_queue WHERE guild_id = ? AND user_id = ?', key
+            )
             await db.execute('''
-                UPDATE tickets SET handler_id = ? WHERE channel_id = ?
+                INSERT INTO ticket_queue (queue_id, guild_id, user_id, category, channel_id, queued_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (
+                entry['queue_id'], entry['guild_id'], entry['user_id'],
+                entry['category'], entry['channel_id'], entry['queued_at']
+            ))
+        if key in self._queued_users:
+            self._pop_queue_entry(self._queued_users[key])
+        self._add_queue_entry(entry)
+    
+    def _reserved_count(self, **filters) -> int:
+        return sum(
+            1 for reservation in self._reservations.values()
+            if all(value is None or reservation[key] == value for key, value in filters.items())
+        )
+    
+    def reserve_ticket(self, category: str, opener_id: int, guild_id: Optional[int] = None) -> int:
+        # Ticket numbers are handed out in memory so nothing is written (and no
+        # placeholder channel_id can collide) until the thread exists. This
+        # process is the only writer of tickets, so the sequence stays unique.
+        ticket_number = self._next_ticket_number
+        self._next_ticket_number += 1
+        self._reservations[ticket_number] = {
+            'category': category,
+            'opener_id': opener_id,
+            'guild_id': guild_id,
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }
+        return ticket_number
+    
+    def release_ticket(self, ticket_number: int):
+        if self._reservations.pop(ticket_number, None) is None:
+            return
+        # Hand the number out again if nothing was reserved after it
+        if ticket_number == self._next_ticket_number - 1:
+            self._next_ticket_number -= 1
+    
+    async def finalize_ticket(self, ticket_number: int, channel_id: int) -> int:
+        reservation = self._reservations[ticket_number]
+        async with self._write() as db:
+            async with db.execute(f'''
+                INSERT INTO tickets (ticket_number, channel_id, category, opener_id, created_at, status, guild_id)
+                VALUES (?, ?, ?, ?, ?, 'open', ?)
+                RETURNING {TICKET_COLUMNS}
+            ''', (
+                ticket_number, channel_id, reservation['category'], reservation['opener_id'],
+                reservation['created_at'], reservation['guild_id']
+            )) as cursor:
+                result = await cursor.fetchone()
+        del self._reservations[ticket_number]
+        self._open_tickets.add(_ticket_from_row(result))
+        if self.capture_messages:
+            self._captured_channels.add(channel_id)
+        return ticket_number
+    
+    async def create_ticket(
+        self,
+        channel_id: int,
+        category: str,
+        opener_id: int,
+        guild_id: Optional[int] = None
+    ) -> int:
+        ticket_number = self.reserve_ticket(category, opener_id, guild_id)
+        try:
+            return await self.finalize_ticket(ticket_number, channel_id)
+        except BaseException:
+            self.release_ticket(ticket_number)
+            raise
+    
+    async def claim_ticket(self, channel_id: int, handler_id: int) -> bool:
+        async with self._write() as db:
+            cursor = await db.execute('''
+                UPDATE tickets SET handler_id = ? WHERE channel_id = ? AND status = 'open'
             ''', (handler_id, channel_id))
-            await db.commit()
+            claimed = cursor.rowcount > 0
+        if claimed:
+            self._open_tickets.set_handler(channel_id, handler_id)
+        return claimed
     
-    async def unclaim_ticket(self, channel_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                UPDATE tickets SET handler_id = NULL WHERE channel_id = ?
+    async def claim_ticket_if_unclaimed(self, channel_id: int, handler_id: int) -> bool:
+        # The check and the write are one statement, so when two staff claim
+        # at once exactly one of them wins; re-claiming your own ticket is a no-op win
+        async with self._write() as db:
+            cursor = await db.execute('''
+                UPDATE tickets SET handler_id = ?
+                WHERE channel_id = ? AND status = 'open' AND (handler_id IS NULL OR handler_id = ?)
+            ''', (handler_id, channel_id, handler_id))
+            claimed = cursor.rowcount > 0
+        if claimed:
+            self._open_tickets.set_handler(channel_id, handler_id)
+        return claimed
+    
+    async def unclaim_ticket(self, channel_id: int) -> bool:
+        async with self._write() as db:
+            cursor = await db.execute('''
+                UPDATE tickets SET handler_id = NULL WHERE channel_id = ? AND status = 'open'
             ''', (channel_id,))
-            await db.commit()
+            unclaimed = cursor.rowcount > 0
+        if unclaimed:
+            self._open_tickets.set_handler(channel_id, None)
+        return unclaimed
     
-    async def close_ticket(self, channel_id: int, closer_id: int, reason: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Get handler_id before closing
-            async with db.execute(
-                'SELECT handler_id FROM tickets WHERE channel_id = ?',
-                (channel_id,)
-            ) as cursor:
-                result = await cursor.fetchone()
-                handler_id = result[0] if result else None
-            
-            await db.execute('''
+    async def unclaim_ticket_if_handler(self, channel_id: int, handler_id: int) -> bool:
+        async with self._write() as db:
+            cursor = await db.execute('''
+                UPDATE tickets SET handler_id = NULL WHERE channel_id = ? AND status = 'open' AND handler_id = ?
+            ''', (channel_id, handler_id))
+            unclaimed = cursor.rowcount > 0
+        if unclaimed:
+            self._open_tickets.set_handler(channel_id, None)
+        return unclaimed
+    
+    async def close_ticket(
+        self,
+        channel_id: int,
+        closer_id: int,
+        reason: str,
+        job: Optional[Tuple[str, Dict]] = None
+    ) -> Optional[Dict]:
+        # Close, credit and read back the ticket in one transaction so a crash
+        # can never leave the ticket closed without its credits (or vice versa).
+        # With write-behind enabled the credits are buffered instead. An optional
+        # (kind, payload) job is queued in the same transaction with the closed
+        # ticket added to its payload.
+        async with self._write() as db:
+            async with db.execute(f'''
                 UPDATE tickets SET 
                     closer_id = ?,
                     close_reason = ?,
                     closed_at = ?,
                     status = 'closed'
-                WHERE channel_id = ?
-            ''', (closer_id, reason, datetime.now(timezone.utc).isoformat(), channel_id))
-            await db.commit()
-            
-            # Add credit to closer
-            await db.execute('''
-                INSERT INTO user_stats (user_id, all_time_closed, weekly_closed)
-                VALUES (?, 1, 1)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    all_time_closed = all_time_closed + 1,
-                    weekly_closed = weekly_closed + 1
-            ''', (closer_id,))
-            await db.commit()
+                WHERE channel_id = ? AND status = 'open'
+                RETURNING {TICKET_COLUMNS}
+            ''', (closer_id, reason, datetime.now(timezone.utc).isoformat(), channel_id)) as cursor:
+                result = await cursor.fetchone()
+            if not result:
+                return None
+            ticket = _ticket_from_row(result)
             
-            # Add credit to handler if they exist
-            if handler_id:
-                await db.execute('''
-                    INSERT INTO user_stats (user_id, all_time_handled, weekly_handled)
-                    VALUES (?, 1, 1)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        all_time_handled = all_time_handled + 1,
-                        weekly_handled = weekly_handled + 1
-                ''', (handler_id,))
-                await db.commit()
+            # Closer gets a close credit, handler (if any) gets a handle credit
+            credits = {closer_id: {'all_time_closed': 1, 'weekly_closed': 1}}
+            if ticket['handler_id']:
+                handler_credit = credits.setdefault(ticket['handler_id'], {})
+                handler_credit.update({'all_time_handled': 1, 'weekly_handled': 1})
+            if not self.write_behind:
+                await self._apply_stat_deltas(db, credits)
+            if job:
+                kind, payload = job
+                await self._insert_job(db, kind, {**payload, 'ticket': ticket})
+        # Buffered credits are only queued once the close has committed, so a
+        # rolled-back close never leaves credits behind
+        if self.write_behind:
+            self._queue_stat_deltas(credits)
+        self._open_tickets.remove(channel_id)
+        return ticket
+    
+    def is_open_ticket(self, channel_id: int) -> bool:
+        return channel_id in self._open_tickets.by_channel
+    
+    def has_full_capture(self, channel_id: int) -> bool:
+        return channel_id in self._captured_channels
+    
+    async def iter_ticket_messages(self, channel_id: int):
+        # Snowflake ids sort chronologically, so the primary key is the order
+        await self.flush_ticket_messages()
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT author, created_at, content FROM ticket_messages
+                WHERE channel_id = ? ORDER BY message_id
+            ''', (channel_id,)) as cursor:
+                async for author, created_at, content in cursor:
+                    yield author, datetime.fromisoformat(created_at), content
+    
+    async def delete_ticket_messages(self, channel_id: int):
+        await self.flush_ticket_messages()
+        self._captured_channels.discard(channel_id)
+        async with self._write() as db:
+            await db.execute('DELETE FROM ticket_messages WHERE channel_id = ?', (channel_id,))
+    
+    async def get_open_ticket_channels(self) -> List[int]:
+        return list(self._open_tickets.by_channel)
+    
+    async def get_user_open_ticket_channels(self, opener_id: int) -> List[int]:
+        return list(self._open_tickets.by_opener.get(opener_id, ()))
+    
+    async def clear_user_tickets(self, opener_id: int):
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE tickets SET status = 'closed' WHERE opener_id = ? AND status = 'open'",
+                (opener_id,)
+            )
+        for channel_id in list(self._open_tickets.by_opener.get(opener_id, ())):
+            self._open_tickets.remove(channel_id)
     
     async def get_ticket_info(self, channel_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
+        ticket = self._open_tickets.by_channel.get(channel_id)
+        if ticket is not None:
+            return dict(ticket)
+        async with self._read() as db:
             async with db.execute(
-                'SELECT * FROM tickets WHERE channel_id = ?',
+                f'SELECT {TICKET_COLUMNS} FROM tickets WHERE channel_id = ?',
                 (channel_id,)
             ) as cursor:
                 result = await cursor.fetchone()
-                if result:
-                    return {
-                        'ticket_number': result[0],
-                        'channel_id': result[1],
-                        'category': result[2],
-                        'opener_id': result[3],
-                        'handler_id': result[4],
-                        'closer_id': result[5],
-                        'created_at': result[6],
-                        'closed_at': result[7],
-                        'close_reason': result[8],
-                        'status': result[9]
-                    }
-                return None
+                return _ticket_from_row(result) if result else None
+    
+    async def _insert_job(self, db: aiosqlite.Connection, kind: str, payload: Dict) -> int:
+        cursor = await db.execute('''
+            INSERT INTO jobs (kind, payload, run_after, created_at) VALUES (?, ?, ?, ?)
+        ''', (kind, json.dumps(payload), time.time(), datetime.now(timezone.utc).isoformat()))
+        return cursor.lastrowid
+    
+    async def claim_job(self) -> Optional[Dict]:
+        # Picks the oldest due job and marks it running in one statement, so
+        # two workers can never take the same job
+        async with self._write() as db:
+            async with db.execute('''
+                UPDATE jobs SET running = 1, attempts = attempts + 1
+                WHERE job_id = (
+                    SELECT job_id FROM jobs
+                    WHERE status = 'pending' AND running = 0 AND run_after <= ?
+                    ORDER BY run_after, job_id LIMIT 1
+                )
+                RETURNING job_id, kind, payload, attempts
+            ''', (time.time(),)) as cursor:
+                result = await cursor.fetchone()
+        if not result:
+            return None
+        return {
+            'job_id': result[0],
+            'kind': result[1],
+            'payload': json.loads(result[2]),
+            'attempts': result[3]
+        }
+    
+    async def next_job_due(self) -> Optional[float]:
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT MIN(run_after) FROM jobs WHERE status = 'pending' AND running = 0"
+            ) as cursor:
+                return (await cursor.fetchone())[0]
+    
+    async def save_job_payload(self, job_id: int, payload: Dict):
+        async with self._write() as db:
+            await db.execute('UPDATE jobs SET payload = ? WHERE job_id = ?', (json.dumps(payload), job_id))
+    
+    async def complete_job(self, job_id: int):
+        async with self._write() as db:
+            await db.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+    
+    async def retry_job(self, job_id: int, delay: float, error: str):
+        async with self._write() as db:
+            await db.execute('''
+                UPDATE jobs SET running = 0, run_after = ?, last_error = ? WHERE job_id = ?
+            ''', (time.time() + delay, error, job_id))
+    
+    async def fail_job(self, job_id: int, error: str):
+        async with self._write() as db:
+            await db.execute('''
+                UPDATE jobs SET running = 0, status = 'failed', last_error = ? WHERE job_id = ?
+            ''', (error, job_id))
     
     async def get_user_stats(self, user_id: int) -> Dict:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
-                'SELECT * FROM user_stats WHERE user_id = ?',
+                f'''SELECT user_id, {self._stats_select()}, profile_message, role_assignment_date
+                FROM user_stats WHERE user_id = ?''',
                 (user_id,)
             ) as cursor:
                 result = await cursor.fetchone()
-                if result:
-                    return {
-                        'user_id': result[0],
-                        'all_time_handled': result[1],
-                        'all_time_closed': result[2],
-                        'weekly_handled': result[3],
-                        'weekly_closed': result[4],
-                        'profile_message': result[5],
-                        'role_assignment_date': result[6]
-                    }
-                return {
-                    'user_id': user_id,
-                    'all_time_handled': 0,
-                    'all_time_closed': 0,
-                    'weekly_handled': 0,
-                    'weekly_closed': 0,
-                    'profile_message': None,
-                    'role_assignment_date': None
-                }
+        if result:
+            stats = {
+                'user_id': result[0],
+                'all_time_handled': result[1],
+                'all_time_closed': result[2],
+                'weekly_handled': result[3],
+                'weekly_closed': result[4],
+                'profile_message': result[5],
+                'role_assignment_date': result[6]
+            }
+        else:
+            stats = {
+                'user_id': user_id,
+                'all_time_handled': 0,
+                'all_time_closed': 0,
+                'weekly_handled': 0,
+                'weekly_closed': 0,
+                'profile_message': None,
+                'role_assignment_date': None
+            }
+        return self._apply_pending(stats)
     
     async def update_profile_message(self, user_id: int, message: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 INSERT INTO user_stats (user_id, profile_message)
                 VALUES (?, ?)
                 ON CONFLICT(user_id) DO UPDATE SET profile_message = ?
             ''', (user_id, message, message))
-            await db.commit()
     
     async def update_role_assignment_date(self, user_id: int, date: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        if self.write_behind:
+            self._queue_stat_set(user_id, 'role_assignment_date', date)
+            return
+        async with self._write() as db:
             await db.execute('''
                 INSERT INTO user_stats (user_id, role_assignment_date)
                 VALUES (?, ?)
                 ON CONFLICT(user_id) DO UPDATE SET role_assignment_date = ?
             ''', (user_id, date, date))
-            await db.commit()
     
     async def modify_stats(self, user_id: int, stat_type: str, value: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(f'''
-                INSERT INTO user_stats (user_id, {stat_type})
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET {stat_type} = {stat_type} + ?
-            ''', (user_id, value, value))
-            await db.commit()
+        if stat_type not in STAT_COLUMNS:
+            raise ValueError(f"Unknown stat: {stat_type}")
+        if self.write_behind:
+            self._queue_stat_deltas({user_id: {stat_type: value}})
+            return
+        async with self._write() as db:
+            await self._apply_stat_deltas(db, {user_id: {stat_type: value}})
     
     async def add_leaderboard_role(self, user_id: int, role_name: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 INSERT OR IGNORE INTO leaderboard_roles (user_id, role_name)
                 VALUES (?, ?)
             ''', (user_id, role_name))
-            await db.commit()
     
     async def remove_leaderboard_role(self, user_id: int, role_name: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 DELETE FROM leaderboard_roles WHERE user_id = ? AND role_name = ?
             ''', (user_id, role_name))
-            await db.commit()
     
     async def get_user_leaderboard_role(self, user_id: int) -> Optional[str]:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 'SELECT role_name FROM leaderboard_roles WHERE user_id = ?',
                 (user_id,)
@@ -286,126 +1178,176 @@ class Database:
                 return result[0] if result else None
     
     async def get_leaderboard_data(self, stat_type: str = 'all_time') -> List[Tuple]:
-        if stat_type == 'all_time':
-            stat_col = 'all_time_handled + all_time_closed'
-        elif stat_type == 'weekly':
-            stat_col = 'weekly_handled + weekly_closed'
-        elif stat_type == 'all_time_closed':
-            stat_col = 'all_time_closed'
-        elif stat_type == 'weekly_closed':
-            stat_col = 'weekly_closed'
-        else:
-            stat_col = 'all_time_handled + all_time_closed'
+        stat_columns = LEADERBOARD_STATS.get(stat_type, LEADERBOARD_STATS['all_time'])
+        stat_col = ' + '.join(self._stat_expr(column) for column in stat_columns)
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(f'''
-                SELECT user_id, all_time_handled, all_time_closed, 
-                       weekly_handled, weekly_closed
+                SELECT user_id, {self._stats_select()}
                 FROM user_stats
                 WHERE {stat_col} > 0
                 ORDER BY {stat_col} DESC
             ''') as cursor:
-                return await cursor.fetchall()
+                rows = await cursor.fetchall()
+            
+            pending_ids = set()
+            for deltas, _ in self._unflushed_buffers():
+                pending_ids.update(deltas)
+            if not pending_ids:
+                return rows
+            
+            # Users with unflushed deltas may be missing from (or mis-ranked in)
+            # the on-disk result, so pull their rows and re-rank in memory
+            missing = pending_ids.difference(row[0] for row in rows)
+            if missing:
+                placeholders = ','.join('?' * len(missing))
+                async with db.execute(f'''
+                    SELECT user_id, {self._stats_select()}
+                    FROM user_stats
+                    WHERE user_id IN ({placeholders})
+                ''', tuple(missing)) as cursor:
+                    rows += await cursor.fetchall()
+        
+        by_user = {row[0]: dict(zip(('user_id',) + STAT_COLUMNS, row)) for row in rows}
+        for user_id in missing:
+            by_user.setdefault(user_id, {'user_id': user_id, **{column: 0 for column in STAT_COLUMNS}})
+        merged = [self._apply_pending(stats) for stats in by_user.values()]
+        merged = [stats for stats in merged if sum(stats[column] for column in stat_columns) > 0]
+        merged.sort(key=lambda stats: sum(stats[column] for column in stat_columns), reverse=True)
+        return [(stats['user_id'], *(stats[column] for column in STAT_COLUMNS)) for stats in merged]
+    
+    async def get_role_leaderboards(
+        self,
+        stat_type: str = 'all_time',
+        rank_by: Tuple[str, ...] = ('all_time_handled',)
+    ) -> Dict[str, List[Dict]]:
+        # One query for every leaderboard section: stats joined to each user's
+        # leaderboard role and ranked within that role. stat_type picks which
+        # users qualify (as in get_leaderboard_data), rank_by the sort columns.
+        stat_columns = LEADERBOARD_STATS.get(stat_type, LEADERBOARD_STATS['all_time'])
+        if not rank_by or not set(rank_by) <= set(STAT_COLUMNS):
+            raise ValueError(f"Invalid leaderboard rank columns: {rank_by}")
+        filter_expr = ' + '.join(self._stat_expr(column, 's.') for column in stat_columns)
+        rank_expr = ' + '.join(self._stat_expr(column, 's.') for column in rank_by)
+        
+        # Buffered credits must be on disk before ranking in SQL
+        await self.flush_stats()
+        async with self._read() as db:
+            async with db.execute(f'''
+                SELECT r.role_name, s.user_id, {self._stats_select('s.')},
+                       RANK() OVER (PARTITION BY r.role_name ORDER BY {rank_expr} DESC) AS rank
+                FROM user_stats s
+                JOIN (
+                    SELECT user_id, MIN(role_name) AS role_name
+                    FROM leaderboard_roles
+                    GROUP BY user_id
+                ) r ON r.user_id = s.user_id
+                WHERE {filter_expr} > 0
+                ORDER BY r.role_name, rank
+            ''') as cursor:
+                rows = await cursor.fetchall()
+        
+        leaderboards: Dict[str, List[Dict]] = {}
+        for role_name, user_id, *stats, rank in rows:
+            entry = {'user_id': user_id, **dict(zip(STAT_COLUMNS, stats)), 'rank': rank}
+            leaderboards.setdefault(role_name, []).append(entry)
+        return leaderboards
     
     async def reset_weekly_stats(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        # Weekly deltas still buffered belong to the week being reset
+        await self.flush_stats()
+        # Archive the finished week, then advance the epoch, which retires
+        # every weekly counter at once without rewriting user_stats
+        now = datetime.now(timezone.utc).isoformat()
+        async with self._write() as db:
             await db.execute('''
-                UPDATE user_stats SET weekly_handled = 0, weekly_closed = 0
-            ''')
+                INSERT INTO weekly_snapshot_weeks (week_epoch, ended_at)
+                VALUES (?, ?)
+            ''', (self._week_epoch, now))
             await db.execute('''
-                INSERT OR REPLACE INTO weekly_reset (id, last_reset)
-                VALUES (1, ?)
-            ''', (datetime.now(timezone.utc).isoformat(),))
-            await db.commit()
+                INSERT INTO weekly_snapshots (week_epoch, user_id, role_name, handled, closed)
+                SELECT s.week_epoch, s.user_id,
+                       (SELECT MIN(role_name) FROM leaderboard_roles r WHERE r.user_id = s.user_id),
+                       s.weekly_handled, s.weekly_closed
+                FROM user_stats s
+                WHERE s.week_epoch = ? AND (s.weekly_handled != 0 OR s.weekly_closed != 0)
+            ''', (self._week_epoch,))
+            async with db.execute('''
+                UPDATE weekly_reset SET week_epoch = week_epoch + 1, last_reset = ?
+                WHERE id = 1
+                RETURNING week_epoch
+            ''', (now,)) as cursor:
+                week_epoch = (await cursor.fetchone())[0]
+        self._week_epoch = week_epoch
+    
+    async def get_user_weekly_history(self, user_id: int, weeks: int = 8) -> List[Dict]:
+        # Most recent finished weeks first; weeks without credit come back as zero
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT w.week_epoch, w.ended_at, COALESCE(s.handled, 0), COALESCE(s.closed, 0)
+                FROM (
+                    SELECT week_epoch, ended_at FROM weekly_snapshot_weeks
+                    ORDER BY week_epoch DESC LIMIT ?
+                ) w
+                LEFT JOIN weekly_snapshots s
+                    ON s.week_epoch = w.week_epoch AND s.user_id = ?
+                ORDER BY w.week_epoch DESC
+            ''', (weeks, user_id)) as cursor:
+                rows = await cursor.fetchall()
+        return [
+            {'week_epoch': week_epoch, 'ended_at': ended_at, 'handled': handled, 'closed': closed}
+            for week_epoch, ended_at, handled, closed in rows
+        ]
+    
+    async def get_role_weekly_history(self, role_name: str, weeks: int = 8) -> List[Dict]:
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT w.week_epoch, w.ended_at,
+                       COALESCE(SUM(s.handled), 0), COALESCE(SUM(s.closed), 0), COUNT(s.user_id)
+                FROM (
+                    SELECT week_epoch, ended_at FROM weekly_snapshot_weeks
+                    ORDER BY week_epoch DESC LIMIT ?
+                ) w
+                LEFT JOIN weekly_snapshots s
+                    ON s.week_epoch = w.week_epoch AND s.role_name = ?
+                GROUP BY w.week_epoch, w.ended_at
+                ORDER BY w.week_epoch DESC
+            ''', (weeks, role_name)) as cursor:
+                rows = await cursor.fetchall()
+        return [
+            {'week_epoch': week_epoch, 'ended_at': ended_at, 'handled': handled, 'closed': closed, 'members': members}
+            for week_epoch, ended_at, handled, closed, members in rows
+        ]
     
     async def set_archive_channel(self, guild_id: int, channel_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO server_config (guild_id, archive_channel_id)
-                VALUES (?, ?)
-                ON CONFLICT(guild_id) DO UPDATE SET archive_channel_id = ?
-            ''', (guild_id, channel_id, channel_id))
-            await db.commit()
+        await self._set_guild_config(guild_id, archive_channel_id=channel_id)
     
     async def get_archive_channel(self, guild_id: int) -> Optional[int]:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                'SELECT archive_channel_id FROM server_config WHERE guild_id = ?',
-                (guild_id,)
-            ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else None
+        return (await self.get_guild_config(guild_id)).archive_channel_id
     
     async def set_ticket_message(self, guild_id: int, message_id: int, channel_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO server_config (guild_id, ticket_message_id, ticket_channel_id)
-                VALUES (?, ?, ?)
-                ON CONFLICT(guild_id) DO UPDATE SET 
-                    ticket_message_id = ?,
-                    ticket_channel_id = ?
-            ''', (guild_id, message_id, channel_id, message_id, channel_id))
-            await db.commit()
+        await self._set_guild_config(guild_id, ticket_message_id=message_id, ticket_channel_id=channel_id)
     
     async def set_leaderboard_channel(self, guild_id: int, channel_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO server_config (guild_id, leaderboard_channel_id)
-                VALUES (?, ?)
-                ON CONFLICT(guild_id) DO UPDATE SET leaderboard_channel_id = ?
-            ''', (guild_id, channel_id, channel_id))
-            await db.commit()
+        await self._set_guild_config(guild_id, leaderboard_channel_id=channel_id)
     
     async def get_leaderboard_channel(self, guild_id: int) -> Optional[int]:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                'SELECT leaderboard_channel_id FROM server_config WHERE guild_id = ?',
-                (guild_id,)
-            ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else None
+        return (await self.get_guild_config(guild_id)).leaderboard_channel_id
     
     async def execute_raw(self, query: str, params: tuple = ()):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(query, params)
-            await db.commit()
+        # A raw statement may have touched tickets behind the index's back
+        await self._load_open_tickets()
     
     async def set_staff_roles(self, guild_id: int, role_ids: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO server_config (guild_id, staff_role_ids)
-                VALUES (?, ?)
-                ON CONFLICT(guild_id) DO UPDATE SET staff_role_ids = ?
-            ''', (guild_id, role_ids, role_ids))
-            await db.commit()
+        await self._set_guild_config(guild_id, staff_role_ids=role_ids)
     
-    async def get_staff_roles(self, guild_id: int) -> List[int]:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                'SELECT staff_role_ids FROM server_config WHERE guild_id = ?',
-                (guild_id,)
-            ) as cursor:
-                result = await cursor.fetchone()
-                if result and result[0]:
-                    return [int(rid) for rid in result[0].split(',')]
-                return []
+    async def get_staff_roles(self, guild_id: int) -> FrozenSet[int]:
+        return (await self.get_guild_config(guild_id)).staff_role_ids
     
     async def set_role_type(self, guild_id: int, role_type: str, role_ids: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(f'''
-                INSERT INTO server_config (guild_id, {role_type}_role_ids)
-                VALUES (?, ?)
-                ON CONFLICT(guild_id) DO UPDATE SET {role_type}_role_ids = ?
-            ''', (guild_id, role_ids, role_ids))
-            await db.commit()
+        await self._set_guild_config(guild_id, **{f'{role_type}_role_ids': role_ids})
     
-    async def get_role_type(self, guild_id: int, role_type: str) -> List[int]:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                f'SELECT {role_type}_role_ids FROM server_config WHERE guild_id = ?',
-                (guild_id,)
-            ) as cursor:
-                result = await cursor.fetchone()
-                if result and result[0]:
-                    return [int(rid) for rid in result[0].split(',')]
-                return []
+    async def get_role_type(self, guild_id: int, role_type: str) -> FrozenSet[int]:
+        return getattr(await self.get_guild_config(guild_id), f'{role_type}_role_ids')
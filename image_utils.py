@@ -1,7 +1,336 @@
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 import aiohttp
+import asyncio
+import concurrent.futures
+import hashlib
 import io
-from typing import Optional
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# One pooled client for every CDN/badge fetch, opened at bot startup
+_http_session: Optional[aiohttp.ClientSession] = None
+
+async def open_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        return
+    connector = aiohttp.TCPConnector(
+        limit=20,
+        limit_per_host=8,
+        ttl_dns_cache=300,
+        keepalive_timeout=60
+    )
+    _http_session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=15)
+    )
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+def http_session() -> aiohttp.ClientSession:
+    if _http_session is None or _http_session.closed:
+        raise RuntimeError("image_utils HTTP session is not open; call open_http_session() first")
+    return _http_session
+
+# Card rendering (resize, blur, PNG encode) runs here instead of on the event
+# loop; the semaphore keeps a burst of .stats from queueing unbounded work
+_render_executor: Optional[concurrent.futures.Executor] = None
+_render_semaphore: Optional[asyncio.Semaphore] = None
+
+def start_render_executor(kind: str = "thread", workers: int = 2):
+    global _render_executor, _render_semaphore
+    if _render_executor is not None:
+        return
+    if kind == "process":
+        # Always spawn: forking the running bot would copy the aiosqlite and
+        # event loop threads into the worker half-initialized
+        _render_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    elif kind == "thread":
+        _render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+    else:
+        raise ValueError(f"Unknown render executor: {kind}")
+    _render_semaphore = asyncio.Semaphore(workers)
+
+def stop_render_executor():
+    global _render_executor, _render_semaphore
+    if _render_executor is not None:
+        _render_executor.shutdown(wait=True, cancel_futures=True)
+        _render_executor = None
+        _render_semaphore = None
+
+async def _run_render(func, *args):
+    loop = asyncio.get_running_loop()
+    if _render_executor is None:
+        # Not started (e.g. scripts); still keep the loop free
+        return await loop.run_in_executor(None, func, *args)
+    async with _render_semaphore:
+        return await loop.run_in_executor(_render_executor, func, *args)
+
+class AssetCache:
+    # Two tiers for CDN assets. Memory holds decoded, already resized/blurred
+    # images keyed by (url, variant); disk holds the raw bytes keyed by a hash
+    # of the URL. Discord asset URLs are content-hashed, so entries never go
+    # stale in place and the TTLs only bound how long unused ones linger.
+    def __init__(
+        self,
+        memory_bytes: int = 64 * 1024 * 1024,
+        memory_ttl: float = 3600.0,
+        disk_dir: str = "asset_cache",
+        disk_bytes: int = 256 * 1024 * 1024,
+        disk_ttl: float = 7 * 24 * 3600.0
+    ):
+        self.memory_bytes = memory_bytes
+        self.memory_ttl = memory_ttl
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.disk_ttl = disk_ttl
+        self._images: "OrderedDict[tuple, Tuple[float, int, Image.Image]]" = OrderedDict()
+        self._memory_used = 0
+        # file name -> (size, mtime), oldest first; scanned from disk on first use
+        self._disk_index: "Optional[OrderedDict[str, Tuple[int, float]]]" = None
+        self._disk_used = 0
+        self._disk_lock = threading.Lock()
+    
+    def get_image(self, key: tuple) -> Optional[Image.Image]:
+        entry = self._images.get(key)
+        if entry is None:
+            return None
+        expires_at, size, image = entry
+        if expires_at <= time.monotonic():
+            del self._images[key]
+            self._memory_used -= size
+            return None
+        self._images.move_to_end(key)
+        return image
+    
+    def put_image(self, key: tuple, image: Image.Image):
+        size = image.width * image.height * len(image.getbands())
+        if size > self.memory_bytes:
+            return
+        old = self._images.pop(key, None)
+        if old is not None:
+            self._memory_used -= old[1]
+        self._images[key] = (time.monotonic() + self.memory_ttl, size, image)
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted_size, _) = self._images.popitem(last=False)
+            self._memory_used -= evicted_size
+    
+    def _disk_name(self, url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+    
+    def _ensure_disk_index(self):
+        # Caller holds _disk_lock
+        if self._disk_index is not None:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        self._disk_index = OrderedDict((name, (size, mtime)) for mtime, name, size in entries)
+        self._disk_used = sum(size for size, _ in self._disk_index.values())
+    
+    def _forget_disk_entry(self, name: str, delete: bool = True):
+        # Caller holds _disk_lock
+        entry = self._disk_index.pop(name, None)
+        if entry is None:
+            return
+        self._disk_used -= entry[0]
+        if delete:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+    
+    def _read_bytes(self, url: str) -> Optional[bytes]:
+        # These run in worker threads concurrently; the index is only touched
+        # under the lock, file contents are read outside it
+        name = self._disk_name(url)
+        with self._disk_lock:
+            self._ensure_disk_index()
+            entry = self._disk_index.get(name)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.disk_ttl:
+                self._forget_disk_entry(name)
+                return None
+            self._disk_index.move_to_end(name)
+        try:
+            with open(os.path.join(self.disk_dir, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            with self._disk_lock:
+                self._forget_disk_entry(name, delete=False)
+            return None
+    
+    def _write_bytes(self, url: str, data: bytes):
+        if len(data) > self.disk_bytes:
+            return
+        name = self._disk_name(url)
+        path = os.path.join(self.disk_dir, name)
+        with self._disk_lock:
+            self._ensure_disk_index()
+        # Write then rename so a crash never leaves a truncated asset behind;
+        # the temp name is per thread so concurrent writers never share it
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._disk_lock:
+            self._forget_disk_entry(name, delete=False)
+            self._disk_index[name] = (len(data), time.time())
+            self._disk_used += len(data)
+            while self._disk_used > self.disk_bytes:
+                self._forget_disk_entry(next(iter(self._disk_index)))
+    
+    async def get_bytes(self, url: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read_bytes, url)
+    
+    async def put_bytes(self, url: str, data: bytes):
+        await asyncio.to_thread(self._write_bytes, url, data)
+
+_asset_cache = AssetCache()
+
+def configure_asset_cache(**options):
+    global _asset_cache
+    _asset_cache = AssetCache(**options)
+
+async def _fetch_asset(url: str) -> Optional[bytes]:
+    data = await _asset_cache.get_bytes(url)
+    if data is not None:
+        return data
+    data = await _fetch_bytes(url)
+    if data is not None:
+        try:
+            await _asset_cache.put_bytes(url, data)
+        except OSError as e:
+            print(f"[DEBUG] Could not cache asset on disk: {e}")
+    return data
+
+async def _fetch_bytes(url: str) -> Optional[bytes]:
+    async with http_session().get(url) as resp:
+        if resp.status != 200:
+            return None
+        return await resp.read()
+
+# Badge art is fetched once, kept in BADGE_DIR and loaded from there on
+# later starts; drop files in by hand to avoid the network entirely
+BADGE_DIR = "badges"
+
+HYPESQUAD_URLS = {
+    'balance': 'https://static.wikia.nocookie.net/zarena/images/0/07/Discord_balance.png',
+    'brilliance': 'https://static.wikia.nocookie.net/zarena/images/8/81/Discord_brilliance.png',
+    'bravery': 'https://static.wikia.nocookie.net/zarena/images/1/1a/Discord_bravery.png'
+}
+
+BADGE_SIZES = {
+    'balance': 45,
+    'brilliance': 45,
+    'bravery': 45,
+    'nitro': 35
+}
+
+async def _fetch_nitro_logo() -> Optional[bytes]:
+    # Nitro logo from the fandom page's og:image
+    nitro_page = 'https://logos.fandom.com/wiki/Discord_Nitro'
+    async with http_session().get(nitro_page) as resp:
+        if resp.status != 200:
+            return None
+        text = await resp.text()
+    m = re.search(r'property="og:image"\s+content="([^"]+)"', text)
+    if not m:
+        m = re.search(r'og:image"\s*content="([^"]+)"', text)
+    if not m:
+        return None
+    img_url = m.group(1)
+    if img_url.startswith('//'):
+        img_url = 'https:' + img_url
+    return await _fetch_bytes(img_url)
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+class BadgeRegistry:
+    def __init__(self, badge_dir: str = BADGE_DIR):
+        self.badge_dir = badge_dir
+        self.badges: Dict[str, Image.Image] = {}
+    
+    def get(self, name: str) -> Optional[Image.Image]:
+        return self.badges.get(name)
+    
+    async def _source(self, name: str) -> Optional[bytes]:
+        path = os.path.join(self.badge_dir, f"{name}.png")
+        data = await asyncio.to_thread(_read_file, path)
+        if data is not None:
+            return data
+        data = await _fetch_nitro_logo() if name == 'nitro' else await _fetch_bytes(HYPESQUAD_URLS[name])
+        if data is not None:
+            await asyncio.to_thread(_write_file, path, data)
+        return data
+    
+    async def _load_badge(self, name: str):
+        try:
+            data = await self._source(name)
+            if data is None:
+                print(f"[DEBUG] Badge '{name}' is unavailable")
+                return
+            size = BADGE_SIZES[name]
+            badge = Image.open(io.BytesIO(data)).convert('RGBA')
+            self.badges[name] = badge.resize((size, size), Image.Resampling.LANCZOS)
+        except Exception as e:
+            print(f"[DEBUG] Error loading badge '{name}': {e}")
+    
+    async def load(self):
+        await asyncio.gather(*(self._load_badge(name) for name in BADGE_SIZES))
+
+_badges = BadgeRegistry()
+
+async def load_badges():
+    await _badges.load()
+
+def _cover(image: Image.Image, width: int, height: int, blur_radius: int) -> Image.Image:
+    # Scale to fill width x height, blur, then center-crop
+    aspect = image.width / image.height
+    target_aspect = width / height
+    
+    if aspect > target_aspect:
+        new_height = height
+        new_width = int(aspect * new_height)
+    else:
+        new_width = width
+        new_height = int(new_width / aspect)
+    
+    image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    image = image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+    
+    x = (new_width - width) // 2
+    y = (new_height - height) // 2
+    return image.crop((x, y, x + width, y + height))
 
 async def create_stats_image(
     user,
@@ -12,91 +341,114 @@ async def create_stats_image(
     has_nitro: bool = False,
     hypesquad_type: Optional[str] = None
 ) -> io.BytesIO:
+    # Prepared images come from the memory tier; raw bytes for anything
+    # missing come from the disk tier or, failing that, the network. Each
+    # distinct URL is fetched once, concurrently, and the CPU-bound render runs
+    # on the render executor.
+    background_url = banner_url or avatar_url
+    background_blur = 10 if banner_url else 15
+    background_key = (background_url, 'cover', background_blur)
+    avatar_key = (avatar_url, 'avatar')
+    background = _asset_cache.get_image(background_key) if background_url else None
+    avatar = _asset_cache.get_image(avatar_key) if avatar_url else None
+    
+    needed = []
+    if background is None and background_url:
+        needed.append(background_url)
+    if avatar is None and avatar_url:
+        needed.append(avatar_url)
+    urls = list(dict.fromkeys(needed))
+    assets = dict(zip(urls, await asyncio.gather(*(_fetch_asset(url) for url in urls))))
+    
+    png, new_background, new_avatar = await _run_render(
+        render_stats_card,
+        background,
+        avatar,
+        None if background is not None or not banner_url else assets.get(banner_url),
+        assets.get(avatar_url),
+        not banner_url,
+        background_blur,
+        username,
+        join_date,
+        has_nitro,
+        _badges.get(hypesquad_type.lower()) if hypesquad_type else None,
+        _badges.get('nitro') if has_nitro else None
+    )
+    if background is None and new_background is not None:
+        _asset_cache.put_image(background_key, new_background)
+    if avatar is None and new_avatar is not None:
+        _asset_cache.put_image(avatar_key, new_avatar)
+    return io.BytesIO(png)
+
+def _fonts():
+    # Loaded per render: FreeType faces must not be shared across render threads
+    try:
+        font_large = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
+        font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 18)
+    except IOError:
+        font_large = ImageFont.load_default()
+        font_small = ImageFont.load_default()
+    return font_large, font_small
+
+def _open_image(data: Optional[bytes]) -> Optional[Image.Image]:
+    if data is None:
+        return None
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+def render_stats_card(
+    background: Optional[Image.Image],
+    avatar: Optional[Image.Image],
+    banner_data: Optional[bytes],
+    avatar_data: Optional[bytes],
+    background_is_avatar: bool,
+    background_blur: int,
+    username: str,
+    join_date: Optional[str],
+    has_nitro: bool,
+    hypesquad_badge: Optional[Image.Image],
+    nitro_logo: Optional[Image.Image]
+) -> Tuple[bytes, Optional[Image.Image], Optional[Image.Image]]:
+    # Pure compute, safe to run in a thread or a separate process. background
+    # and avatar are prepared images from the cache; when one is missing it is
+    # built from the raw bytes and handed back so the caller can cache it.
     width = 885
     height = 303
     
     img = Image.new('RGB', (width, height), color=(0, 0, 0))
     
-    if banner_url:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(banner_url) as resp:
-                if resp.status == 200:
-                    banner_data = await resp.read()
-                    banner = Image.open(io.BytesIO(banner_data))
-                    
-                    aspect = banner.width / banner.height
-                    target_aspect = width / height
-                    
-                    if aspect > target_aspect:
-                        new_height = height
-                        new_width = int(aspect * new_height)
-                    else:
-                        new_width = width
-                        new_height = int(new_width / aspect)
-                    
-                    banner = banner.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    banner = banner.filter(ImageFilter.GaussianBlur(radius=10))
-                    
-                    x = (new_width - width) // 2
-                    y = (new_height - height) // 2
-                    banner = banner.crop((x, y, x + width, y + height))
-                    
-                    img.paste(banner, (0, 0))
-    else:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(avatar_url) as resp:
-                if resp.status == 200:
-                    avatar_data = await resp.read()
-                    avatar_bg = Image.open(io.BytesIO(avatar_data))
-                    
-                    aspect = avatar_bg.width / avatar_bg.height
-                    target_aspect = width / height
-                    
-                    if aspect > target_aspect:
-                        new_height = height
-                        new_width = int(aspect * new_height)
-                    else:
-                        new_width = width
-                        new_height = int(new_width / aspect)
-                    
-                    avatar_bg = avatar_bg.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    avatar_bg = avatar_bg.filter(ImageFilter.GaussianBlur(radius=15))
-                    
-                    x = (new_width - width) // 2
-                    y = (new_height - height) // 2
-                    avatar_bg = avatar_bg.crop((x, y, x + width, y + height))
-                    
-                    img.paste(avatar_bg, (0, 0))
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(avatar_url) as resp:
-            if resp.status == 200:
-                avatar_data = await resp.read()
-                avatar = Image.open(io.BytesIO(avatar_data))
-                avatar = avatar.resize((250, 250), Image.Resampling.LANCZOS)
-                
-                mask = Image.new('L', (250, 250), 0)
-                mask_draw = ImageDraw.Draw(mask)
-                mask_draw.ellipse((0, 0, 250, 250), fill=255)
-                
-                # Create shadow for avatar circle at full image size
-                shadow_layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-                shadow_draw = ImageDraw.Draw(shadow_layer)
-                shadow_draw.ellipse((30, 26, 280, 276), fill=(0, 0, 0, 100))
-                shadow_layer = shadow_layer.filter(ImageFilter.GaussianBlur(radius=12))
-                img.paste(shadow_layer, (0, 0), shadow_layer)
-                
-                img.paste(avatar, (30, 26), mask)
+    # Each asset is decoded at most once; without a banner the avatar doubles
+    # as the blurred background
+    avatar_img = _open_image(avatar_data) if avatar is None or (background is None and background_is_avatar) else None
+    if avatar is None and avatar_img:
+        avatar = avatar_img.resize((250, 250), Image.Resampling.LANCZOS)
+    if background is None:
+        source = avatar_img if background_is_avatar else _open_image(banner_data)
+        if source:
+            background = _cover(source, width, height, background_blur)
+    
+    if background:
+        img.paste(background, (0, 0))
+    
+    if avatar:
+        mask = Image.new('L', (250, 250), 0)
+        mask_draw = ImageDraw.Draw(mask)
+        mask_draw.ellipse((0, 0, 250, 250), fill=255)
+        
+        # Create shadow for avatar circle at full image size
+        shadow_layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        shadow_draw = ImageDraw.Draw(shadow_layer)
+        shadow_draw.ellipse((30, 26, 280, 276), fill=(0, 0, 0, 100))
+        shadow_layer = shadow_layer.filter(ImageFilter.GaussianBlur(radius=12))
+        img.paste(shadow_layer, (0, 0), shadow_layer)
+        
+        img.paste(avatar, (30, 26), mask)
     
     img = img.convert('RGBA')
     draw = ImageDraw.Draw(img)
     
-    try:
-        font_large = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
-        font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 18)
-    except IOError:
-        font_large = ImageFont.load_default()
-        font_small = ImageFont.load_default()
+    font_large, font_small = _fonts()
     
     username_bbox = draw.textbbox((0, 0), username, font=font_large)
     username_width = username_bbox[2] - username_bbox[0]
@@ -158,75 +510,18 @@ async def create_stats_image(
     badge_y = 15
     badge_x = width - 20
     
-    if hypesquad_type:
-        hypesquad_urls = {
-            'balance': 'https://static.wikia.nocookie.net/zarena/images/0/07/Discord_balance.png',
-            'brilliance': 'https://static.wikia.nocookie.net/zarena/images/8/81/Discord_brilliance.png',
-            'bravery': 'https://static.wikia.nocookie.net/zarena/images/1/1a/Discord_bravery.png'
-        }
-        
-        badge_url = hypesquad_urls.get(hypesquad_type.lower())
-        if badge_url:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(badge_url) as resp:
-                        if resp.status == 200:
-                            badge_data = await resp.read()
-                            badge_img = Image.open(io.BytesIO(badge_data)).convert('RGBA')
-                            badge_img = badge_img.resize((45, 45), Image.Resampling.LANCZOS)
-                            img.paste(badge_img, (width - 55, badge_y), badge_img)
-                            badge_x -= 60
-            except Exception as e:
-                print(f"[DEBUG] Error loading hypesquad badge: {e}")
+    # Badges arrive pre-resized from the badge registry
+    if hypesquad_badge:
+        img.paste(hypesquad_badge, (width - 55, badge_y), hypesquad_badge)
+        badge_x -= 60
     
     if has_nitro:
         nitro_size = 35
         badge_x_pos = badge_x - nitro_size - 10
         badge_y_pos = badge_y
 
-        # Try to fetch a Nitro logo from the supplied fandom page (uses og:image meta fallback)
-        nitro_img = None
-        nitro_page = 'https://logos.fandom.com/wiki/Discord_Nitro'
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(nitro_page) as resp:
-                    if resp.status == 200:
-                        text = await resp.text()
-                        import re
-                        m = re.search(r'property="og:image"\s+content="([^"]+)"', text)
-                        if not m:
-                            m = re.search(r'og:image"\s*content="([^"]+)"', text)
-                        if m:
-                            img_url = m.group(1)
-                            if img_url.startswith('//'):
-                                img_url = 'https:' + img_url
-                            try:
-                                async with session.get(img_url) as iresp:
-                                    if iresp.status == 200:
-                                        nitro_data = await iresp.read()
-                                        nitro_img = Image.open(io.BytesIO(nitro_data)).convert('RGBA')
-                            except Exception:
-                                nitro_img = None
-        except Exception as e:
-            print(f"[DEBUG] Error fetching Nitro logo page: {e}")
-
-        if nitro_img:
-            try:
-                nitro_img = nitro_img.resize((nitro_size, nitro_size), Image.Resampling.LANCZOS)
-                img.paste(nitro_img, (badge_x_pos, badge_y_pos), nitro_img)
-            except Exception as e:
-                print(f"[DEBUG] Error processing Nitro image: {e}")
-                # fallback to simple badge
-                draw.ellipse(
-                    [(badge_x_pos, badge_y_pos), (badge_x_pos + nitro_size, badge_y_pos + nitro_size)],
-                    fill=(127, 75, 200)
-                )
-                bbox = draw.textbbox((0, 0), "N", font=font_small)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-                text_x = badge_x_pos + (nitro_size - text_w) // 2
-                text_y = badge_y_pos + (nitro_size - text_h) // 2
-                draw.text((text_x, text_y), "N", fill=(255, 255, 255), font=font_small)
+        if nitro_logo:
+            img.paste(nitro_logo, (badge_x_pos, badge_y_pos), nitro_logo)
         else:
             # fallback: draw a small purple circle with 'N'
             draw.ellipse(
@@ -246,5 +541,4 @@ async def create_stats_image(
     
     output = io.BytesIO()
     border_img.save(output, format='PNG')
-    output.seek(0)
-    return output
+    return output.getvalue(), background, avatar
@@ -0,0 +1,108 @@
+import asyncio
+import time
+import traceback
+from typing import Awaitable, Callable, Dict, List
+from database import Database
+
+# A handler gets the job payload and a checkpoint callback that persists an
+# updated payload, so a retried job can skip the steps it already finished
+JobHandler = Callable[[Dict, Callable[[Dict], Awaitable[None]]], Awaitable[None]]
+
+class JobFailed(Exception):
+    # Raised by a handler when retrying cannot help; the job is failed at once
+    pass
+
+class JobQueue:
+    def __init__(
+        self,
+        db: Database,
+        workers: int = 2,
+        max_attempts: int = 6,
+        base_delay: float = 5.0,
+        max_delay: float = 600.0,
+        poll_interval: float = 30.0
+    ):
+        self.db = db
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.handlers: Dict[str, JobHandler] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def register(self, kind: str, handler: JobHandler):
+        self.handlers[kind] = handler
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self.db.claim_job()
+            except Exception as e:
+                print(f"[JOBS] Could not claim a job: {e}")
+                job = None
+            if job is None:
+                await self._sleep()
+                continue
+            try:
+                await self._run(job)
+            except Exception as e:
+                print(f"[JOBS] Could not record the result of job {job['job_id']}: {e}")
+
+    async def _sleep(self):
+        timeout = self.poll_interval
+        try:
+            next_due = await self.db.next_job_due()
+        except Exception:
+            next_due = None
+        if next_due is not None:
+            timeout = min(timeout, max(0.0, next_due - time.time()))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self, job: Dict):
+        job_id = job['job_id']
+        handler = self.handlers.get(job['kind'])
+
+        async def checkpoint(payload: Dict):
+            await self.db.save_job_payload(job_id, payload)
+
+        try:
+            if handler is None:
+                raise JobFailed(f"No handler registered for {job['kind']}")
+            await handler(job['payload'], checkpoint)
+        except asyncio.CancelledError:
+            # Left marked running; init_db hands it back out after a restart
+            raise
+        except JobFailed as e:
+            print(f"[JOBS] Job {job_id} ({job['kind']}) failed: {e}")
+            await self.db.fail_job(job_id, str(e))
+        except Exception as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            if job['attempts'] >= self.max_attempts:
+                print(f"[JOBS] Job {job_id} ({job['kind']}) gave up after {job['attempts']} attempts: {error}")
+                await self.db.fail_job(job_id, error)
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** (job['attempts'] - 1))
+                print(f"[JOBS] Job {job_id} ({job['kind']}) failed, retrying in {delay:.0f}s: {error}")
+                await self.db.retry_job(job_id, delay, error)
+        else:
+            await self.db.complete_job(job_id)
@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# (capacity, refill period in seconds): a bucket holds at most `capacity`
+# tokens and regains all of them over `period` seconds
+BucketSpec = Tuple[float, float]
+
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, spec: BucketSpec, now: float):
+        capacity, period = spec
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    def __init__(self, user: Optional[BucketSpec] = None, guild: Optional[BucketSpec] = None,
+                 global_: Optional[BucketSpec] = None, max_keys: int = 10000):
+        self.user_spec = user
+        self.guild_spec = guild
+        self.max_keys = max_keys
+        self.user_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.guild_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.global_bucket = TokenBucket(global_, time.monotonic()) if global_ else None
+
+    def _bucket(self, buckets: OrderedDict, spec: Optional[BucketSpec], key: Optional[int], now: float) -> Optional[TokenBucket]:
+        if spec is None or key is None:
+            return None
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(spec, now)
+            # Least recently used keys go first; an evicted bucket would have
+            # refilled to capacity anyway unless it was hit very recently
+            while len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    def acquire(self, user_id: Optional[int], guild_id: Optional[int] = None) -> float:
+        # Returns 0 and spends one token from every bucket if all of them have
+        # one, otherwise spends nothing and returns the seconds until they do
+        now = time.monotonic()
+        if self.global_bucket:
+            self.global_bucket.refill(now)
+        buckets = [bucket for bucket in (
+            self._bucket(self.user_buckets, self.user_spec, user_id, now),
+            self._bucket(self.guild_buckets, self.guild_spec, guild_id, now),
+            self.global_bucket
+        ) if bucket is not None]
+
+        retry_after = max((bucket.retry_after() for bucket in buckets), default=0.0)
+        if retry_after > 0:
+            return retry_after
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return 0.0
@@ -0,0 +1,72 @@
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, Tuple
+import discord
+
+# Transcripts stay in memory up to this size, then spill to a temp file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+class Transcript:
+    def __init__(self, ticket_number: int, spool_max_size: int = SPOOL_MAX_SIZE):
+        self.ticket_number = ticket_number
+        self.filename = f"ticket #{ticket_number}.html"
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+        self.message_count = 0
+        self._write(f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Ticket #{ticket_number}</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; padding: 20px; background: #36393f; color: #dcddde; }}
+        .message {{ margin: 10px 0; padding: 10px; background: #40444b; border-radius: 5px; }}
+        .author {{ color: #7289da; font-weight: bold; }}
+        .timestamp {{ color: #72767d; font-size: 0.8em; }}
+    </style>
+</head>
+<body>
+    <h1>Ticket #{ticket_number}</h1>
+""")
+
+    def _write(self, text: str):
+        self.buffer.write(text.encode())
+
+    def add_message(self, author: str, created_at: datetime, content: str):
+        timestamp = created_at.strftime("%Y-%m-%d %H:%M:%S")
+        content = content.replace('<', '&lt;').replace('>', '&gt;')
+        self._write(f'    <div class="message"><span class="author">{author}</span> <span class="timestamp">{timestamp}</span><br>{content}</div>\n')
+        self.message_count += 1
+
+    def finish(self):
+        self._write("</body>\n</html>")
+
+    def to_file(self) -> discord.File:
+        # Every upload gets its own File over the same rewound buffer, so the
+        # archive post and the DM share one rendered transcript
+        self.buffer.seek(0)
+        return discord.File(self.buffer, filename=self.filename)
+
+    def close(self):
+        self.buffer.close()
+
+async def _render(ticket_number: int, messages: AsyncIterator[Tuple[str, datetime, str]]) -> Transcript:
+    transcript = Transcript(ticket_number)
+    try:
+        async for author, created_at, content in messages:
+            transcript.add_message(author, created_at, content)
+        transcript.finish()
+    except BaseException:
+        transcript.close()
+        raise
+    return transcript
+
+async def _history(channel: discord.abc.Messageable):
+    async for message in channel.history(limit=None, oldest_first=True):
+        yield str(message.author), message.created_at, message.content
+
+async def write_transcript(ticket_number: int, channel: discord.abc.Messageable) -> Transcript:
+    return await _render(ticket_number, _history(channel))
+
+async def write_captured_transcript(ticket_number: int, messages: AsyncIterator[Tuple[str, datetime, str]]) -> Transcript:
+    # Renders from rows captured live (Database.iter_ticket_messages)
+    return await _render(ticket_number, messages)
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+import discord
+
+class UserResolver:
+    def __init__(self, client: discord.Client, max_size: int = 1000, ttl: float = 600.0):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (expires_at, user); None is cached too so unknown ids are
+        # not fetched again on every lookup
+        self._cache: "OrderedDict[int, Tuple[float, Optional[discord.User]]]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+    def _cached(self, user_id: int, guild: Optional[discord.Guild]):
+        # Gateway caches cost nothing, so they are always tried first
+        if guild is not None:
+            member = guild.get_member(user_id)
+            if member is not None:
+                return True, member
+        user = self.client.get_user(user_id)
+        if user is not None:
+            return True, user
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(user_id)
+                return True, user
+            del self._cache[user_id]
+        return False, None
+
+    async def _fetch(self, user_id: int) -> Optional[discord.User]:
+        try:
+            user = await self.client.fetch_user(user_id)
+        except discord.NotFound:
+            user = None
+        self._cache[user_id] = (time.monotonic() + self.ttl, user)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return user
+
+    async def resolve(self, user_id: int, guild: Optional[discord.Guild] = None) -> Optional[discord.abc.User]:
+        found, user = self._cached(user_id, guild)
+        if found:
+            return user
+        # Concurrent lookups of the same id share one REST call
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def resolve_many(self, user_ids: Iterable[Optional[int]], guild: Optional[discord.Guild] = None) -> Dict[int, Optional[discord.abc.User]]:
+        ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+        users = await asyncio.gather(*(self.resolve(user_id, guild) for user_id in ids))
+        return dict(zip(ids, users))